@@ -67,167 +67,718 @@ file_name = None
 control_name = None # Name of control under "treatment" column
 plot_name = None
 datasheet_name = None
+batch_tests = True # Run pairwise tests of all exon pairs in batched calls
+p_value_for_confidence = "raw" # "raw" or "adjusted" p-value in confidence score
+workers = 1 # Number of processes to run treatments in
+co_splicing_order = 2 # Largest number of exons in a co-spliced set (2: exon pairs)
+compact_dtypes = False # Compact in-memory datasheet: categoricals, Int8 exon flags, float32 abundances
+ci_method = None # Resampling intervals of diff_relative_abundance: "bootstrap", "permutation" or None
+ci_resamples = 1000 # Number of resamples per row
+ci_level = 0.95 # Confidence level of the interval
+ci_seed = 0 # Seed of the resampling
+ci_chunk_mb = 64 # Memory for resampled differences per chunk of rows, in megabytes
+stream_chunksize = None # Rows per chunk in streaming mode (None: load whole datasheet)
+spill_directory = None # Directory for spill files of streaming mode
+cache_directory = None # Directory of the result cache (None: no cache)
+cache_size_limit = 1024 # Size cap of the result cache in megabytes
+plot_webgl_threshold = 5000 # Events above which the plot uses WebGL markers
+plot_density_threshold = None # Events above which a binned density plot is drawn (None: never)
+plot_bins = 200 # Number of bins per axis of the density plot
+plot_include_plotlyjs = True # True (inline), "directory" (shared plotly.min.js) or "cdn"
+log_level = "INFO" # Logging level: "DEBUG" also logs every exon pair pattern examined
+metrics_file = None # JSON file for stage timings and counters (None: not written)
+validation_report = None # JSON file for problems found in the datasheet (None: not written)
+make_plot = True # Generate the HTML plot (False: compute and export the datasheet only)
+incremental_output = False # Write each experimental unit to the output datasheet as it completes, with a checkpoint
+min_diff_relative_abundance = None # Drop events below this diff_relative_abundance before tests (None: keep)
+min_magnitude = None # Drop events below this magnitude before tests (None: keep)
+max_p_value = None # Drop events above this raw p-value (None: keep)
+top_k_events = None # Keep the top k events by confidence score per experimental unit (None: all)
+mwu_exact_max = 20 # Exact Mann-Whitney U tables up to this many replicates per group (None: scipy's choice)
 
 # Modules
 import sys
-from user_inputs import *
+from time import perf_counter
+# Start of the import stage (see Metrics)
+import_start = perf_counter()
+# User-defined parameters are read from user_inputs.py when csi.py is run as
+# a script; functions take everything they need as arguments, so csi can also
+# be imported without user_inputs.py (see compute_csi)
+try:
+    from user_inputs import *
+except ImportError:
+    pass
 import pandas as pd
+import logging
+import json
+from collections import Counter
+from contextlib import contextmanager
 from os import chdir
 from os import mkdir
+from os import listdir
+from os import remove
+from os import replace
+from os import stat
+from os import utime
 from os.path import join
+from os.path import getsize
+from os.path import splitext
+from os.path import dirname
+from tempfile import TemporaryDirectory
+from tempfile import NamedTemporaryFile
+from zlib import crc32
+from hashlib import sha256
+import pickle
+import numpy as np
 from numpy import NaN
-import plotly.express as px
 from math import log
-from collections import OrderedDict
+from math import comb
 from itertools import combinations
-from scipy.stats import mannwhitneyu
-from scipy.stats import ttest_ind
-from scipy.stats import levene
-from scipy.stats import normaltest
-
-# Given a list of [(1.0, a), (3.0, b), (2.0, c)...], where a, b, c are floats,
-# return (a, b, c)
-def sort_replicates(lst):
-    d = {}
-    final_lst = []
-    
-    # Generate dictionary
-    for x, y in lst:
-        d[x] = y
-        
-    # Make sorted dictionary into OrderedDict to preserve the order
-    od = OrderedDict(sorted(d.items()))
+from heapq import heappush
+from heapq import heappushpop
+from multiprocessing import Pool
+# scipy.stats (pairwise tests) and plotly (plot) are imported where they are 
+# used, so they are only loaded when a unit has replicates to test and when a
+# plot is made
+
+
+## Instrumentation
+# Progress and errors are logged to the "csi" logger; the script logs to 
+# stdout at log_level. Functions given a Counter (counts) add to it: exon sets
+# and patterns examined, patterns skipped, tests run by type and rows emitted.
+logger = logging.getLogger("csi")
+
+# Wall time of each stage (seconds) and counters of one run, written to a 
+# JSON metrics file with save()
+class Metrics:
+    def __init__(self):
+        self.stages = {}
+        self.counts = Counter()
     
-    # Return list of values in sorted OrderedDict
-    for key, value in od.items():
-        final_lst += [value]
+    # Time the enclosed block as stage name (times add up if it is repeated)
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + perf_counter() - start
     
-    return final_lst
+    def to_dict(self):
+        return {"stages": self.stages, 
+                "total_seconds": sum(self.stages.values()),
+                "counts": dict(self.counts)}
+    
+    def save(self, path):
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file, indent=2)
 
-def initiate(directory, file_name):
+# Merge biological replicates in one grouped pass.
+# Rows that are identical in every column except "replicate_ID" and 
+# "relative_abundance" are replicates of the same isoform. They are collapsed 
+# into one row where "replicates" holds the relative_abundance values ordered 
+# by replicate_ID (e.g. [a, b, c] for replicates 1, 2, 3) and 
+# "relative_abundance" is their mean. Rows without replicates keep 
+# "replicates" = nan. Grouping hashes the key columns once (NaN-safe, so exon 
+# columns filled with NA compare equal), instead of comparing every row pair.
+def merge_replicates(df):
+    key_cols = list(df.columns[:-2])
     
-    ## Import data
-    print("Importing data from specified directory")
-    chdir(directory)
-    df = pd.read_csv(file_name)
-
-    ## Check if NA values in dataframe is in valid format
-    print("Check dataframe for invalid NAs")
-    if "Na" in df.values or "na" in df.values or "nA" in df.values:
-        print("")
-        print("Warning: 'Na', 'na' or 'nA' detected in dataframe.")
-        print("Please replace all non-applicable exons to NA or nan.")
-        print("")
-        print("If this warning is irrelevant, ")
-        print("(i.e. Na/ na/ nA is name of expt_unit/ cell_line/ treatment/ isoform/),")
-        txt = input("press y and Enter to continue")
-        if txt.upper().replace(" ","") == "Y" or txt.upper.replace(" ","") =="YES" or \
-            txt.upper().replace(" ","") == "YE" or txt.upper().replace(" ","") == "YEAH":
-            pass
-        else:
-            sys.exit("NA Nomenclature Error: Please rename datasheet cells.")
+    # Number each group of identical key columns by order of first appearance
+    group_id = df.groupby(key_cols, sort=False, dropna=False).ngroup().to_numpy()
+    is_dup = np.bincount(group_id)[group_id] > 1
+    
+    # Rows without biological replicates are kept as they are
+    df_single = df[~is_dup].copy()
+    df_single.insert(len(df_single.columns), 'replicates', NaN)
+    
+    # Sort duplicated rows by group, then by replicate_ID. The sort is stable,
+    # so if a replicate_ID is repeated within a group the last row wins.
+    df_dup = df[is_dup]
+    gid = group_id[is_dup]
+    rep_id = df_dup["replicate_ID"].to_numpy(dtype=float)
+    order = np.lexsort((rep_id, gid))
+    gid = gid[order]
+    rep_id = rep_id[order]
+    keep = np.ones(len(gid), dtype=bool)
+    keep[:-1] = (gid[1:] != gid[:-1]) | (rep_id[1:] != rep_id[:-1])
+    gid = gid[keep]
+    ra = df_dup["relative_abundance"].to_numpy(dtype=float)[order][keep].tolist()
+    
+    # Slice the sorted values into one list of replicates per group
+    starts = np.flatnonzero(np.diff(gid, prepend=-1)).tolist()
+    ends = starts[1:] + [len(ra)]
+    replicates = [ra[s:e] for s, e in zip(starts, ends)]
+    
+    # One row per group, taken from its first occurrence in df
+    df_merged = df_dup.iloc[:, :-2].drop_duplicates(keep='first')
+    df_merged.insert(len(df_merged.columns), 'replicate_ID', NaN)
+    df_merged.insert(len(df_merged.columns), 'relative_abundance', 
+                     [sum(x)/len(x) for x in replicates])
+    df_merged.insert(len(df_merged.columns), 'replicates', 
+                     pd.Series(replicates, index=df_merged.index, dtype=object))
+    
+    return pd.concat([df_single, df_merged])
+
+# File formats of datasheets by file extension. CSV is text; Parquet and 
+# Feather (Arrow IPC) are typed, columnar formats and need pyarrow.
+datasheet_formats = {".csv": "csv",
+                     ".parquet": "parquet", ".pq": "parquet",
+                     ".feather": "feather", ".arrow": "feather"}
+
+# Format of a datasheet file from its extension; unknown extensions are CSV
+def datasheet_format(path):
+    return datasheet_formats.get(splitext(str(path))[1].lower(), "csv")
+
+# Explicit dtypes of the numeric columns of an input datasheet: exon flags 
+# (NA as nan), replicate_ID and relative_abundance are float64
+def datasheet_dtypes(columns):
+    return {col: np.float64 for col in list(columns)[5:]}
+
+# Read an input datasheet, choosing the format from the file extension.
+# Columnar files keep their stored types; numeric columns are cast to the 
+# explicit dtypes of datasheet_dtypes.
+def read_datasheet(path):
+    fmt = datasheet_format(path)
+    if fmt == "csv":
+        return pd.read_csv(path)
+    if fmt == "parquet":
+        df = pd.read_parquet(path)
     else:
-        print("NA check passed")
-    
-    ## Check if exons are in valid format
-    print("Check if exons are in valid format")
-    col = list(df.columns)[5:-2]
-    for i in range(len(col)):
-        # Check if E is present
-        if "E" not in col[i]:
-            print("")
-            print("Error: Exon columns need to be named with consequtive E{num} e.g. E1 E2 E3")
-            sys.exit("Exon Column Nomenclature Error: Please rename exon columns.")
-        # Check if numbers are consequtive (i.e. E1, E2, E3...)
-        if i+1 == int(col[i].replace("E","")):
-            pass
-        else:
-            print("")
-            print("Error: Exon columns are not in consequtive numbers, e.g. E1 E3...")
-            sys.exit("Exon Column Error: Please ensure exon columns are consequtive.")
-    print("Exon format check passed")
+        df = pd.read_feather(path)
+    return df.astype(datasheet_dtypes(df.columns))
+
+# Read an input datasheet in chunks of chunksize rows (dataframes), choosing
+# the format from the file extension. Columnar files are read by record 
+# batch; Feather files are memory-mapped.
+def iter_datasheet_chunks(path, chunksize):
+    fmt = datasheet_format(path)
+    if fmt == "csv":
+        yield from pd.read_csv(path, chunksize=chunksize)
+        return
     
-    ## Check for biological replicates
-    print("Processing biological replicates")
-    # Add all duplicates into another dataframe
-    df_dup = df[df.duplicated(subset=list(df.columns[0:-2]), keep=False)]
-    
-    # Make a dataframe with empty relative_abundance and replicate_ID
-    df_dup_empty = pd.DataFrame(df_dup.iloc[:,:-2].values, columns = df.iloc[:,:-2].columns).drop_duplicates(keep = 'first')
-    
-    df_dup_empty.insert(len(df_dup_empty.columns),'replicate_ID', NaN)
-    df_dup_empty.insert(len(df_dup_empty.columns),'relative_abundance', NaN)
-    
-    # Add replicates column to both dataframes
-    df_dup_empty.insert(len(df_dup_empty.columns),'replicates', NaN)
-    df_dup.insert(len(df_dup.columns),'replicates', NaN)
-    
-    # Add replicates of relative_abundance values to df_dup_empty
-    df_dup_empty.loc[:,'replicates'] = df_dup_empty.loc[:,'replicates'].astype('object')
-    for index1, row1 in df_dup_empty.iterrows():
-        for index2, row2 in df_dup.iterrows():
-            # Remove NAs in list for list comparison
-            # e.g. lst1 = [a, b, c, nan] 
-            #      lst2 = [a, b, c, nan]
-            # Then lst1 =/= lst2 because of the nan, so we remove nan 
-            clean_lst1 = list(row1[:-3].dropna())
-            clean_lst2 = list(row2[:-3].dropna())
-            
-            # If all values in row (except for "replicate_ID", "relative_abundance",
-            # and "replicates") are the same between df_dup and df_dup_empty,
-            # then add replicates from df_dup to df_dup_empty's "replicates"
-            if clean_lst1 == clean_lst2:
-                if type(df_dup_empty.loc[index1, "replicates"]) != list:
-                    df_dup_empty.at[index1, "replicates"] = [ (row2["replicate_ID"] ,str(row2["relative_abundance"])) ]
-                else:
-                    df_dup_empty.at[index1, "replicates"] += [ (row2["replicate_ID"] , str(row2["relative_abundance"])) ]
-            else:
-                pass
-                
-    # Sort replicate list: replicates column now has a list of e.g.
-    # [(4.0, d), (3.0, c), (2.0, b), (1.0, a)], which we need to sort 
-    # and return[a, b, c, d] using function sort_replicates(lst)
-    for index, row in df_dup_empty.iterrows():
-        df_dup_empty.at[index, "replicates"] = sort_replicates(df_dup_empty.loc[index, "replicates"])
-    
-    # Calculate mean using the replicates and add the mean to relative_abundance
-    for index1, row1 in df_dup_empty.iterrows():
-        # Convert the strings in replicates to floats 
-        df_dup_empty.at[index1, "replicates"] = [ float(x) for x in df_dup_empty.loc[index1, "replicates"] ]
-        # Calculate mean using the replicates
-        df_dup_empty.loc[index1, "relative_abundance"] = sum(df_dup_empty.loc[index1, "replicates"])/len(df_dup_empty.loc[index1, "replicates"])
-
-    # Add duplicates as rows with relative_abundance = mean, and keep all the 
-    # relative_abundance values as a tuple in df['replicates']
-    df.loc[:,'replicates'] = NaN
-        
-    # Drop all duplicates in original df
-    df = df.drop_duplicates(subset= list(df.columns[0:-3]), keep = False)
+    if fmt == "parquet":
+        import pyarrow.parquet
+        batches = pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunksize)
+    else:
+        import pyarrow.feather
+        batches = pyarrow.feather.read_table(path, memory_map=True).to_batches(max_chunksize=chunksize)
+    for batch in batches:
+        df = batch.to_pandas()
+        yield df.astype(datasheet_dtypes(df.columns))
+
+# Number of rows of a datasheet file: read from the metadata of columnar
+# files, estimated for CSV from the file size and the text size of chunk 
+# (some of its first rows)
+def estimate_datasheet_rows(path, chunk):
+    fmt = datasheet_format(path)
+    if fmt == "parquet":
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetFile(path).metadata.num_rows
+    if fmt == "feather":
+        import pyarrow.feather
+        return pyarrow.feather.read_table(path, memory_map=True).num_rows
+    bytes_per_row = max(1, len(chunk.to_csv(index=False)) // max(1, len(chunk)))
+    return getsize(path) // bytes_per_row
+
+# Write a datasheet (e.g. df_final), choosing the format from the file 
+# extension. Feather files are written uncompressed so that the next stage 
+# can memory-map them.
+def write_datasheet(df, path):
+    fmt = datasheet_format(path)
+    if fmt == "csv":
+        df.to_csv(path_or_buf = path, index=False)
+    elif fmt == "parquet":
+        df.to_parquet(path, index=False)
+    else:
+        df.reset_index(drop=True).to_feather(path, compression="uncompressed")
+
+# Path of the output datasheet; datasheet_name without a known extension is
+# written as CSV
+def datasheet_path(directory, datasheet_name):
+    if splitext(datasheet_name)[1].lower() in datasheet_formats:
+        return f"{directory}/output_datasheets/{datasheet_name}"
+    return f"{directory}/output_datasheets/{datasheet_name}.csv"
+
+## Validation
+# The whole datasheet is checked against every rule in one pass before any 
+# calculation, without prompting, and all problems are reported together. 
+# Each problem is a dictionary: rule, severity ("error" stops the run, 
+# "warning" does not), message, count of rows or units concerned and up to 
+# report_limit examples (row: index of the row in the datasheet, unit: 
+# expt_unit and cell_line, with the first row of each unit example in rows).
+# Problems are reported in the order of validation_rules.
+id_columns = ["expt_unit", "cell_line", "treatment", "isoform", "exons"]
+invalid_na_spellings = ["Na", "na", "nA"]
+report_limit = 10
+validation_rules = ["columns", "exon_columns", "na_spelling", "missing_values", "exon_values",
+                    "exon_count", "unit_exons", "relative_abundance", "relative_abundance_sum",
+                    "duplicate_isoform", "isoform_pattern", "missing_control"]
+
+# Errors of the input datasheet (issues: the problems found by 
+# validate_datasheet) and of user parameters. Library functions raise them; 
+# csi.py and csi_shard.py exit with their message.
+class DatasheetError(ValueError):
+    def __init__(self, message, issues=None):
+        super().__init__(message)
+        self.issues = issues or []
+
+class ParameterError(ValueError):
+    pass
+
+def validation_issue(rule, severity, message, rows=None, units=None):
+    issue = {"rule": rule, "severity": severity, "message": message}
+    if rows is not None:
+        issue["count"] = len(rows)
+        issue["rows"] = [int(row) for row in list(rows)[:report_limit]]
+    if units is not None:
+        issue["units"] = [[str(x) for x in unit] for unit in list(units)[:report_limit]]
+    return issue
+
+# Problems with the columns of the datasheet: expt_unit ... exons first, 
+# replicate_ID and relative_abundance last, and exon columns in between named
+# with consecutive E{num} (E1, E2, E3...)
+def column_issues(columns):
+    columns = [str(column) for column in columns]
+    issues = []
+    if columns[:5] != id_columns or columns[-2:] != ["replicate_ID", "relative_abundance"]:
+        issues += [validation_issue("columns", "error", 
+            "Columns must be expt_unit, cell_line, treatment, isoform, exons, E1..En, "
+            f"replicate_ID, relative_abundance; found {', '.join(columns)}")]
+    for i, column in enumerate(columns[5:-2]):
+        if column != f"E{i + 1}":
+            issues += [validation_issue("exon_columns", "error",
+                f"Exon column {i + 1} is named '{column}'; exon columns need to be named with "
+                "consecutive E{num} e.g. E1 E2 E3")]
+    return issues
+
+# Check every rule on datasheet df (as read from file, before replicates are
+# merged) for treatments compared against control_name; returns the list of 
+# problems found. Identifier columns are factorized once and the per-unit 
+# rules run on the integer codes.
+def validate_datasheet(df, control_name, ra_tolerance=0.01):
+    issues = column_issues(df.columns)
+    if issues:
+        # Other rules depend on the position of the columns
+        return issues
+    
+    # Identifier and other text columns as integer codes (-1: missing)
+    exon_cols = list(df.columns[5:-2])
+    text_cols = [x for x in df.columns if df[x].dtype == object or x in id_columns + ["replicate_ID"]]
+    codes = {}
+    na_cells = {}
+    for x in text_cols:
+        codes[x], uniques = pd.factorize(df[x].to_numpy())
+        # Cells spelled 'Na', 'na' or 'nA', looked up once per distinct value
+        na_cells[x] = np.append(np.isin(np.asarray(uniques, dtype=object), invalid_na_spellings), 
+                                False)[codes[x]]
+    codes = pd.DataFrame(codes, index=df.index)
+    na_cells = pd.DataFrame(na_cells, index=df.index)
+    
+    # Rows without any identifier are blank rows, dropped by preprocess
+    blank = (codes[id_columns] < 0).all(axis=1).to_numpy()
+    if blank.any():
+        df, codes, na_cells = df[~blank], codes[~blank], na_cells[~blank]
+    codes["unit"] = codes.groupby(["expt_unit", "cell_line"], sort=False).ngroup()
+    
+    ## NA spelling: 'Na', 'na' or 'nA' instead of NA. In an exon column this
+    #  makes the exon flags text; elsewhere it may be a legitimate name
+    in_exons = na_cells[[x for x in text_cols if x in exon_cols]].any(axis=1)
+    in_names = na_cells[[x for x in text_cols if x not in exon_cols]].any(axis=1)
+    if in_exons.any():
+        issues += [validation_issue("na_spelling", "error", 
+            "'Na', 'na' or 'nA' in exon columns; replace all non-applicable exons with NA or nan",
+            rows=df.index[in_exons])]
+    if in_names.any():
+        issues += [validation_issue("na_spelling", "warning", 
+            "'Na', 'na' or 'nA' outside exon columns; ignore if it is the name of an "
+            "expt_unit, cell_line, treatment or isoform", rows=df.index[in_names])]
+    
+    ## Missing identifiers (factorize codes missing values as -1)
+    missing = (codes[id_columns + ["replicate_ID"]] < 0).any(axis=1)
+    if missing.any():
+        issues += [validation_issue("missing_values", "error",
+            "Empty expt_unit, cell_line, treatment, isoform, exons or replicate_ID",
+            rows=df.index[missing])]
+    
+    ## Exon flags must be 0, 1 or NA, and each row must have one flag for 
+    #  every exon listed in "exons" (counted once per distinct "exons")
+    flags = df[exon_cols].apply(pd.to_numeric, errors='coerce')
+    bad_flags = (df[exon_cols].notna() & (flags != 0) & (flags != 1)).any(axis=1) & ~in_exons
+    if bad_flags.any():
+        issues += [validation_issue("exon_values", "error", 
+            "Exon columns must be 1 (present), 0 (absent) or NA (no such exon)",
+            rows=df.index[bad_flags])]
+    exon_lists = pd.Series(pd.factorize(df["exons"].to_numpy())[1]).astype(str)
+    n_listed = (exon_lists.str.replace(" ", "").str.count(",") + 1).to_numpy()
+    n_flags = flags.notna().sum(axis=1).to_numpy()
+    wrong_count = (codes["exons"] >= 0) & (n_listed[codes["exons"]] != n_flags)
+    if wrong_count.any():
+        issues += [validation_issue("exon_count", "error", 
+            f"Number of exons in 'exons' does not match the number of exon columns filled "
+            f"(at most {len(exon_cols)})", rows=df.index[wrong_count])]
+    
+    ## Every experimental unit must list the same exons in all of its rows
+    unit_exons = codes[["unit", "exons"]].drop_duplicates()
+    mixed = unit_exons["unit"].duplicated(keep=False)
+    if mixed.any():
+        rows = codes["unit"].drop_duplicates()
+        rows = rows[rows.isin(unit_exons["unit"][mixed])].index
+        issues += [validation_issue("unit_exons", "error", 
+            "Experimental unit has rows with different 'exons'; give each experiment its own "
+            "expt_unit name", rows=rows,
+            units=list(df.loc[rows, ["expt_unit", "cell_line"]].itertuples(index=False, name=None)))]
+    
+    ## Relative abundance must be numbers from 0 to 1 and sum to 1 in every
+    #  replicate of every treatment
+    ra = pd.to_numeric(df["relative_abundance"], errors='coerce')
+    bad_ra = ra.isna() | (ra < 0) | (ra > 1)
+    if bad_ra.any():
+        issues += [validation_issue("relative_abundance", "error",
+            "relative_abundance must be a number from 0 to 1", rows=df.index[bad_ra])]
+    replicate = codes[["unit", "treatment", "replicate_ID"]]
+    sums = ra.groupby([replicate[x] for x in replicate.columns], sort=False).transform("sum")
+    off = ((sums - 1).abs() > ra_tolerance) & ~replicate.duplicated()
+    if off.any():
+        issues += [validation_issue("relative_abundance_sum", "warning", 
+            f"relative_abundance of a replicate does not sum to 1 (+/- {ra_tolerance})",
+            rows=off[off].index, units=list(df.loc[off[off].index, ["expt_unit", "cell_line", "treatment", "replicate_ID"]]
+                       .itertuples(index=False, name=None)))]
     
-    # Add filled df_dup_empty to df
-    df = df.append(df_dup_empty)
-    print("Biological replicates processed")
+    ## Isoform names must be unique within each replicate of a treatment, and 
+    #  name the same exon pattern throughout the unit
+    duplicated = codes.duplicated(["unit", "treatment", "replicate_ID", "isoform"], keep=False)
+    if duplicated.any():
+        issues += [validation_issue("duplicate_isoform", "error",
+            "Isoform appears more than once in the same replicate of a treatment",
+            rows=df.index[duplicated])]
+    pattern = (flags.fillna(-1).to_numpy() + 1) @ (3 ** np.arange(len(exon_cols), dtype=float))
+    patterns = pd.DataFrame({"unit": codes["unit"], "isoform": codes["isoform"], "pattern": pattern})
+    patterns = patterns.drop_duplicates()
+    renamed = patterns.duplicated(["unit", "isoform"], keep=False)
+    if renamed.any():
+        rows = patterns[renamed].drop_duplicates(["unit", "isoform"]).index
+        issues += [validation_issue("isoform_pattern", "warning",
+            "Isoform name is used for different exon patterns in one experimental unit", rows=rows,
+            units=list(df.loc[rows, ["expt_unit", "cell_line", "isoform"]].itertuples(index=False, name=None)))]
+    
+    ## Every experimental unit needs the control
+    controlled = np.zeros(len(df), dtype=bool)
+    controlled[codes["unit"][(df["treatment"] == control_name).to_numpy()]] = True
+    first = codes["unit"].drop_duplicates()
+    rows = first[~controlled[first]].index
+    if len(rows) > 0:
+        issues += [validation_issue("missing_control", "error",
+            f"Control '{control_name}' not found; include the control or ensure that the control "
+            "name in input datasheet matches control_name user parameter", rows=rows,
+            units=list(df.loc[rows, ["expt_unit", "cell_line"]].itertuples(index=False, name=None)))]
+    return issues
+
+# Problems of a whole datasheet from the problems found by validate_datasheet
+# in each of its parts (lists of issues; parts hold whole experimental units
+# and keep the row numbers of the datasheet): one problem per rule, severity
+# and message, with counts added and the report_limit examples of the 
+# lowest rows
+def merge_issues(parts):
+    merged = {}
+    for issues in parts:
+        for issue in issues:
+            key = (issue["rule"], issue["severity"], issue["message"])
+            if key not in merged:
+                merged[key] = {"rule": issue["rule"], "severity": issue["severity"], 
+                               "message": issue["message"], "count": 0, "examples": []}
+            merged[key]["count"] += issue.get("count", 0)
+            if "rows" in issue:
+                merged[key]["examples"] += list(zip(issue["rows"], 
+                                                    issue.get("units", [None] * len(issue["rows"]))))
+    
+    issues = []
+    rank = {rule: i for i, rule in enumerate(validation_rules)}
+    for key in sorted(merged, key=lambda key: (rank.get(key[0], len(rank)), key[1] != "error")):
+        issue = merged[key]
+        examples = sorted(issue.pop("examples"))[:report_limit]
+        if issue["count"] == 0:
+            del issue["count"]
+        else:
+            issue["rows"] = [row for row, unit in examples]
+            if examples[0][1] is not None:
+                issue["units"] = [unit for row, unit in examples]
+        issues += [issue]
+    return issues
+
+# Log the problems found by validate_datasheet, write them as JSON to 
+# report_path (if given) and raise DatasheetError if any is an error
+def check_datasheet(issues, report_path=None):
+    errors = [issue for issue in issues if issue["severity"] == "error"]
+    for issue in issues:
+        where = issue.get("units", issue.get("rows", ""))
+        count = f" ({issue['count']}: {where})" if "count" in issue else ""
+        log = logger.error if issue["severity"] == "error" else logger.warning
+        log(f"{issue['severity'].capitalize()} [{issue['rule']}]: {issue['message']}{count}")
+    if report_path is not None:
+        with open(report_path, "w") as file:
+            json.dump({"errors": len(errors), "warnings": len(issues) - len(errors),
+                       "issues": issues}, file, indent=2)
+    if errors:
+        raise DatasheetError(f"Datasheet Validation Error: {len(errors)} problem(s) found, see above.",
+                             issues)
+    logger.info("Datasheet validation passed")
+
+# Check the columns of the datasheet (all problems are logged) and raise if
+# they are not valid
+def check_exon_columns(columns):
+    logger.info("Check if exons are in valid format")
+    check_datasheet(column_issues(columns))
+
+# Merge biological replicates and drop empty rows of a checked datasheet, or
+# of any part of it that holds whole experimental units
+def preprocess(df):
+    ## Check for biological replicates
+    logger.info("Processing biological replicates")
+    df = merge_replicates(df)
+    logger.info("Biological replicates processed")
     
     # Drop rows if nan in all of the cells of "expt_unit","cell_line","treatment","isoform" & "exons" 
     df = df.dropna(subset=["expt_unit","cell_line","treatment","isoform","exons"], how='all')
     return df
 
-# Generate treatment_list for all treatments to be compared against control
-def make_trmt_list(df):
-    print("Generating list of all possible treatment conditions")
+# Memory used by df in bytes, including the Python objects held by object
+# columns (strings, and the lists of "replicates" with their floats)
+def working_set_size(df):
+    size = df.memory_usage(index=True, deep=True).sum()
+    if "replicates" in df.columns:
+        size += sum(len(x) for x in df["replicates"] if type(x) == list) * sys.getsizeof(0.0)
+    return int(size)
+
+# Compact in-memory representation of a preprocessed datasheet: identifiers 
+# as categoricals, exon flags as nullable Int8, replicate_ID and 
+# relative_abundance as float32, and the "replicates" lists packed into 
+# float32 columns replicates_1 ... replicates_n in place of "replicates" 
+# (padded with nan like replicate_matrix). Row subsets (iloc, masks, groupby)
+# keep the dtypes. Relative abundances keep about 7 significant digits, so 
+# results can differ from the float64 datasheet in the last digits, and events
+# whose diff_relative_abundance is within rounding of 0 can be kept or 
+# filtered out (finalize_results) differently. The working-set size before 
+# and after is logged and added to counts (Counter) if given.
+def compact_datasheet(df, counts=None):
+    before = working_set_size(df)
+    exon_cols = list(df.columns[5:-3])
+    rep = replicate_matrix(df["replicates"]).astype(np.float32)
+    df = df.drop(columns="replicates").astype({**{col: "category" for col in id_columns},
+                                               **{col: "Int8" for col in exon_cols},
+                                               "replicate_ID": np.float32,
+                                               "relative_abundance": np.float32})
+    for i in range(rep.shape[1]):
+        df[f"replicates_{i + 1}"] = rep[:, i]
+    after = working_set_size(df)
+    
+    logger.info(f"Working set compacted from {before / 1024**2:.1f} MB to {after / 1024**2:.1f} MB")
+    if counts is not None:
+        counts["working_set_bytes"] += before
+        counts["compact_working_set_bytes"] += after
+    return df
+
+# Dense replicate matrix (see replicate_matrix) of the rows of df, from the
+# "replicates" lists or from the packed columns of compact_datasheet
+def frame_replicate_matrix(df):
+    if "replicates" in df.columns:
+        return replicate_matrix(df["replicates"])
+    return df[[col for col in df.columns if str(col).startswith("replicates_")]].to_numpy(dtype=float)
+
+# Rows of df at positions rows (one experimental unit) as a frame of their 
+# own, with the dtypes of compact_datasheet widened to numpy ones: 
+# categoricals to object, Int8 and float32 to float64 (NA as nan), in one 
+# block per dtype. A unit is small and PreparedUnit slices it many times, 
+# which is much faster on a few numpy blocks; a worker process also does not
+# receive the categories of the whole datasheet.
+def unit_frame(df, rows):
+    if all(isinstance(dtype, np.dtype) and dtype != np.float32 for dtype in df.dtypes):
+        return df.iloc[rows]
+    # Rows are taken column by column from the arrays of df, which is much
+    # faster than iloc on many extension columns
+    columns = {}
+    for col, dtype in df.dtypes.items():
+        values = df[col].array.take(rows)
+        if isinstance(dtype, pd.CategoricalDtype) or dtype == object:
+            columns[col] = np.asarray(values, dtype=object)
+        else:
+            columns[col] = values.to_numpy(dtype=float, na_value=NaN)
+    return pd.DataFrame(columns, index=df.index[rows])
+
+# Stages are timed in metrics (Metrics) if given; problems found in the 
+# datasheet are written to report_path (if given) as JSON. With compact, the
+# datasheet is returned in the compact representation of compact_datasheet.
+def initiate(directory, file_name, control_name, metrics=None, report_path=None, compact=False):
+    metrics = Metrics() if metrics is None else metrics
+    
+    ## Import data
+    logger.info("Importing data from specified directory")
+    chdir(directory)
+    with metrics.stage("read"):
+        df = read_datasheet(file_name)
+
+    ## Check the whole datasheet before any calculation
+    logger.info("Validating datasheet")
+    with metrics.stage("validation"):
+        check_datasheet(validate_datasheet(df, control_name), report_path)
+    
+    with metrics.stage("replicate_merge"):
+        df = preprocess(df)
+    if compact:
+        with metrics.stage("compact"):
+            df = compact_datasheet(df, metrics.counts)
+    return df
+
+# Generate treatment_list for all treatments to be compared against control,
+# as (expt_unit, cell_line, treatment) in order of first appearance, from one
+# grouping pass over df. Also returns unit_rows, the row positions of every 
+# experimental unit: unit_rows[(EU, cell_type)] slices the unit with df.iloc
+# without querying df again.
+def make_trmt_list(df, control_name):
+    logger.info("Generating list of all possible treatment conditions")
+    groups = df.groupby(["expt_unit", "cell_line", "treatment"], sort=False, observed=True).indices
+    
     treatment_list = []
-    for EU in list(set(df["expt_unit"])):
-        for cell_type in list(set(df.query(f"expt_unit=='{EU}'")["cell_line"])):
-            for treatment in list(set(df.query(f"expt_unit=='{EU}' & cell_line=='{cell_type}'")["treatment"])):
-                if treatment != control_name:
-                    treatment_list += [(EU, cell_type, treatment)]
-    print("All possible treatment conditions generated")
-    return treatment_list
-
-# Given dfT and dfC, exon 1 and exon2, presence1/2 (must be integer 1 or 0)
-# returns (diff_RA, contributing_isoforms, total_isoforms, RA_cont_spliced_isoform)
-##check input to presence1/2 must be integer
-def calc_diffRA(df_treatment, df_control, exon1, exon2, presence1, presence2, dfCont):
+    unit_rows = {}
+    for (EU, cell_type, treatment), rows in groups.items():
+        unit_rows.setdefault((EU, cell_type), []).append(rows)
+        if treatment != control_name:
+            treatment_list += [(EU, cell_type, treatment)]
+    unit_rows = {key: np.sort(np.concatenate(rows)) for key, rows in unit_rows.items()}
+    logger.info("All possible treatment conditions generated")
+    return treatment_list, unit_rows
+
+# Encode the exon presence of every isoform as an integer bitmask: bit i is 
+# set if the i-th exon column is 1, e.g. E1=1, E2=0, E3=1 gives 0b101
+def encode_exon_bitmask(df, exon_cols):
+    if len(exon_cols) > 63:
+        raise DatasheetError("Exon Column Error: At most 63 exons with splicing activity are supported.")
+    flags = (df[exon_cols].to_numpy(dtype=float) == 1).astype(np.int64)
+    return (flags << np.arange(len(exon_cols), dtype=np.int64)).sum(axis=1)
+
+# Given isoform bitmasks and exon sets (array of exon column positions, one 
+# row per set of k exons), return the presence pattern of every exon set in 
+# every isoform as an integer code of shape (n_sets, n_isoforms). The first 
+# exon of the set is the highest bit, so for exon pair (e1, e2):
+# 1-1 -> 3, 1-0 -> 2, 0-1 -> 1, 0-0 -> 0
+def exon_pattern_codes(masks, exon_sets):
+    k = exon_sets.shape[1]
+    bits = (masks[None, :, None] >> exon_sets[:, None, :]) & 1
+    return (bits << np.arange(k - 1, -1, -1, dtype=np.int64)).sum(axis=2)
+
+# Sum values (e.g. relative_abundance per isoform) over the isoforms sharing a
+# presence pattern, for every exon set and every pattern in one pass.
+# values is either one value per isoform, giving an array of shape 
+# (n_sets, 2**k) indexed by [set, pattern code], or a dense isoform x replicate
+# array, giving per-replicate sums of shape (n_sets, 2**k, n_replicates).
+# Isoforms are added in row order, like sum() over a df.query() subset, so
+# the sums are identical to the ones from querying each pattern. A NaN 
+# (isoform without that replicate) makes the per-replicate sum NaN.
+def pattern_sums(codes, values, k):
+    n_sets, n_isoforms = codes.shape
+    n_patterns = 2 ** k
+    bins = (codes + n_patterns * np.arange(n_sets)[:, None]).ravel()
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        weights = np.broadcast_to(values, codes.shape).ravel()
+        sums = np.bincount(bins, weights=weights, minlength=n_sets * n_patterns)
+        return sums.reshape(n_sets, n_patterns)
+    
+    n_replicates = values.shape[1]
+    sums = np.zeros((n_sets * n_patterns, n_replicates))
+    np.add.at(sums, bins, np.broadcast_to(values, (n_sets,) + values.shape).reshape(n_sets * n_isoforms, n_replicates))
+    return sums.reshape(n_sets, n_patterns, n_replicates)
+
+# Convert the "replicates" column (nan, or list of relative_abundance ordered
+# by replicate_ID) into a dense float array of shape (n_isoforms, n_replicates).
+# Column r holds the r-th replicate of every isoform; isoforms without 
+# replicates, or with fewer replicates, are padded with NaN.
+def replicate_matrix(replicates):
+    lists = [x if type(x) == list else [] for x in replicates]
+    lengths = np.array([len(x) for x in lists], dtype=np.int64)
+    rep = np.full((len(lists), lengths.max(initial=0)), NaN)
+    rows = np.repeat(np.arange(len(lists)), lengths)
+    cols = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    rep[rows, cols] = [value for x in lists for value in x]
+    return rep
+
+# Given the per-replicate sums of the isoforms with one presence pattern (one
+# row of the replicate pattern table) and their summed relative_abundance, 
+# return (replicate_list, mean).
+# If the isoforms have replicates, e.g. 
+#      Replicate     1    2
+#      isoform A [ 0.2, 0.3 ] 
+#      isoform B [ 0.15, 0.33 ]
+# the row holds the per-replicate totals [0.35, 0.63] and the mean is their 
+# average. Replicates missing from any of the isoforms are NaN and dropped. 
+# Without replicates, replicate_list is nan and the mean is the summed 
+# relative_abundance.
+def replicate_mean(rep_sums, ra_sum):
+    replicate_list = rep_sums[~np.isnan(rep_sums)].tolist()
+    if len(replicate_list) == 0:
+        return NaN, ra_sum
+    return replicate_list, sum(replicate_list)/len(replicate_list)
+
+# Pattern tables of the isoforms of one condition (bitmasks masks, relative
+# abundance ra, dense replicate matrix rep) for every exon set in exon_sets: 
+# (sums, nonzero, rep_sums), where sums[s, code] is the summed relative 
+# abundance of the isoforms with pattern code in set s, nonzero[s, code] 
+# the number of those isoforms with nonzero relative abundance and 
+# rep_sums[s, code] their per-replicate sums
+def pattern_tables(masks, ra, rep, exon_sets):
+    k = exon_sets.shape[1]
+    codes = exon_pattern_codes(masks, exon_sets)
+    return (pattern_sums(codes, ra, k), pattern_sums(codes, ra != 0, k).astype(int),
+            pattern_sums(codes, rep, k))
+
+# Order in which the presence patterns of a set of k exons are examined: all
+# exons present, all absent, then the other patterns by descending code, 
+# e.g. for k = 2: 1-1, 0-0, 1-0, 0-1
+def pattern_order(k):
+    full = 2**k - 1
+    return np.array([full, 0] + list(range(full - 1, 0, -1)), dtype=np.int64)
+
+# Type of co-splicing of a control presence pattern code of k exons: the
+# treatment pattern is its complement, so all present in control is 
+# co-exclusion, all absent is co-inclusion, and anything else is exchange
+def splicing_type(code, k):
+    if code == 2**k - 1:
+        return "co-exclusion"
+    if code == 0:
+        return "co-inclusion"
+    return "exchange"
+
+# Candidate sets of k exons for the next order, from the sets of k - 1 exons
+# (sorted tuples of exon positions, in lexicographic order) that had at least
+# one event. An event in a set of k exons is also an event in each of its 
+# subsets (the same control and treatment isoforms match the sub-patterns),
+# so a set is only a candidate if all of its k - 1 subsets had events 
+# (apriori pruning). Returns candidates in lexicographic order, as 
+# combinations() would.
+def next_exon_sets(live_sets, k):
+    live = set(live_sets)
+    last_of = {}
+    for exon_set in live_sets:
+        last_of.setdefault(exon_set[:-1], []).append(exon_set[-1])
+    candidates = []
+    for prefix, lasts in last_of.items():
+        for a, b in combinations(lasts, 2):
+            candidate = prefix + (a, b)
+            if all(subset in live for subset in combinations(candidate, k - 1)):
+                candidates += [candidate]
+    return candidates
+
+# Check co_splicing_order: sets of at least 2 exons (an integer)
+def check_co_splicing_order(order):
+    if type(order) != int or order < 2:
+        raise ParameterError("Parameter Error: co_splicing_order must be an integer of 2 or more.")
+
+# Given (replicate_list, mean) of the treatment and control isoforms with the
+# co-spliced exon1-exon2 presence pattern (see replicate_mean), and the 
+# isoform counts read from the pattern tables, 
+# returns (diff_RA, contributing_isoforms, cospliced_isoforms, 
+#          RA_cont_spliced_isoform, treatment_list, control_list)
+def calc_diffRA(treatment, control, contributing_isoforms, cospliced_isoforms):
     ### Get sum of replicates for treatment and control
     # e.g. For treatment dataframe,
     #              exon1    exon2    exon3    replicates
@@ -241,176 +792,18 @@ def calc_diffRA(df_treatment, df_control, exon1, exon2, presence1, presence2, df
     # control dataframe and, say, we get (0.1, 0.2, 0.17).
     # We can then do pairwise comparison between (0.5, 0.7, 0.55) and 
     # (0.1, 0.2, 0.17) to get p-value.
-    
-    ## Calculations for treatment dataframe 
-    sub_dfT = df_treatment.query(f'{exon1}=={presence1} & {exon2}=={presence2}')
-    treatment_list = sub_dfT["replicates"]
-    if type(treatment_list) == pd.core.series.Series:
-        treatment_list = list(treatment_list)
-        
-    # Possible input to the conditionals below:
-        # If there are no replicates, one isoform, treatment_list is nan
-        # If there are no replicates, multiple isoforms, treatment_list is [nan, nan ...]
-        # If there are replicates, one isoform, treatment_list is [0.3, 0.34, 0.31...]
-        # If there are replicates, multiple isoforms, treatment_list is [ [0.3, 0.34, 0.31...], [0.3, 0.34, 0.31...] ...]
-    
-    try:
-        if type(treatment_list) == list:
-            # if treatment list is nested list e.g. [ [0.3, 0.2], [0.3, 0.3]...]
-            if type(treatment_list[0]) == list:
-                # if first item is NaN
-                if pd.isna(treatment_list[0][0]):
-                    treatment_list = NaN
-                    treatment_sum = sum(sub_dfT["relative_abundance"])
-                    
-                # if there are no NaN, len of treatment list > 1 means there are replicates,
-                elif len(treatment_list[0]) > 1:
-                    raise ReplicateDetected      
-                    
-                else:
-                    print("Error: Unexpected input detected in calc_diffRA")
-                    sys.exit()
-            # if first item is NaN
-            if pd.isna(treatment_list[0]):
-                treatment_list = NaN
-                treatment_sum = sum(sub_dfT["relative_abundance"])
-                
-            # if there are no NaN, len of treatment list > 1 means there are replicates,
-            elif len(treatment_list) > 1:
-                raise ReplicateDetected      
-                
-            else:
-                print("Error: Unexpected input detected in calc_diffRA")
-                sys.exit()
-        
-        # if not list, then it must be nan, if not then sys.exit to prevent calc error
-        elif pd.isna(treatment_list):
-            treatment_list = NaN
-            treatment_sum = sum(sub_dfT["relative_abundance"]) 
-            
-        else:
-            print("Error: Unexpected input detected in calc_diffRA")
-            sys.exit()
-            
-        # Only two possible inputs to the conditionals below:
-            # Nested list of len 1: [[0.2, 0.3...]]
-            # Nested list of len >1: [ [0.2, 0.3], [0.15, 0.33] ]
-    except ReplicateDetected:
-        # If there is only one isoform, we get nested list of len 1
-        
-        if len(treatment_list) == 1:
-            treatment_list = treatment_list[0]
-            
-        # If more than 1 isoform, we get a nested list of len > 1
-        #      Replicate     1    2
-        # E.g. isoform A [ [0.2, 0.3], 
-        #      isoform B   [0.15, 0.33] ]
-        # We can zip to put values from same replicate in a list
-        # then sum them: after zip = [ [0.2, 0.15], [0.3, 0.33] ]
-        #                after sum = [ 0.35, 0.63 ]
-        elif len(treatment_list) > 1:
-            zip_treatment_list = list(zip(*treatment_list))
-            treatment_list = [sum(x) for x in zip_treatment_list]
-            
-        # treatment_sum is the mean of treatment_list
-        treatment_sum = sum(treatment_list)/len(treatment_list)
-        
-        
-        
-        
-    ## Calculations for control dataframe 
-    sub_dfC = df_control.query(f'{exon1}=={presence1} & {exon2}=={presence2}')
-    control_list = list(sub_dfC["replicates"])
-    if type(control_list) == pd.core.series.Series:
-        control_list = list(control_list)    
-        
-    # Possible input to the conditionals below:
-        # If there are no replicates, one isoform, control_list is nan
-        # If there are no replicates, multiple isoforms, control_list is [nan, nan ...]
-        # If there are replicates, one isoform, control_list is [0.3, 0.34, 0.31...]
-        # If there are replicates, multiple isoforms, control_list is [ [0.3, 0.34, 0.31...], [0.3, 0.34, 0.31...] ...]
-    
-    try:
-        if type(control_list) == list:
-            # if control list is nested list e.g. [ [0.3, 0.2], [0.3, 0.3]...]
-            if type(control_list[0]) == list:
-                # if first item is NaN
-                if pd.isna(control_list[0][0]):
-                    control_list = NaN
-                    control_sum = sum(sub_dfC["relative_abundance"])
-                    
-                # if there are no NaN, len of treatment list > 1 means there are replicates,
-                elif len(control_list[0]) > 1:
-                    raise ReplicateDetected      
-                    
-                else:
-                    print("Error: Unexpected input detected in calc_diffRA")
-                    sys.exit()
-            # if first item is NaN, means there are no replicates
-            if pd.isna(control_list[0]):
-                control_list = NaN
-                control_sum = sum(sub_dfC["relative_abundance"])
-                
-            # if there are no NaN, len of control list > 1 means there are replicates,
-            elif len(control_list) > 1:
-                raise ReplicateDetected      
-                
-            else:
-                print("Error: Unexpected input detected in calc_diffRA")
-                sys.exit()
-        
-        # if not list, then it must be nan, if not then sys.exit to prevent calc error
-        elif pd.isna(control_list):
-            control_list = NaN
-            control_sum = sum(sub_dfC["relative_abundance"]) 
-            
-        else:
-            print("Error: Unexpected input detected in calc_diffRA")
-            sys.exit()
-            
-        # Only two possible inputs to the conditionals below:
-            # Nested list of len 1: [[0.2, 0.3...]]
-            # Nested list of len >1: [ [0.2, 0.3], [0.15, 0.33] ]
-    except ReplicateDetected:
-        
-        # If there is only one isoform, thus we get a list of len 1
-        if len(control_list) == 1:
-            control_list = control_list[0]
-            
-        # If more than 1 isoform, we get a nested list of len > 1
-        #      Replicate     1    2
-        # E.g. isoform A [ [0.2, 0.3], 
-        #      isoform B   [0.15, 0.33] ]
-        # We can zip to put values from same replicate in a list
-        # then sum them: after zip = [ [0.2, 0.15], [0.3, 0.33] ]
-        #                after sum = [ 0.35, 0.63 ]
-        elif len(control_list) > 1:
-            zip_control_list = list(zip(*control_list))
-            control_list = [sum(x) for x in zip_control_list]
-            
-        # control_sum is the mean of control_list
-        control_sum = sum(control_list)/len(control_list)
+    # These per-replicate sums are computed for all exon pairs at once by
+    # pattern_sums on the dense replicate matrix of each condition.
+    treatment_list, treatment_sum = treatment
+    control_list, control_sum = control
     
     diff_RA = treatment_sum - control_sum
     
-    
     ## contributing_isoforms: number of isoforms used in sum of exon2:presence2 (control)
     # The lower the number of non-zero isoforms in control, in treatment, the more 
     # confident that the isoforms in control are contributing to the target co-spliced form
-    sub_dfC_nonzero = dfCont.query('relative_abundance != 0') 
-    contributing_isoforms = len(sub_dfC_nonzero)
-    
-    # Reset to save memory
-    sub_dfC = None
-    sub_dfC_nonzero = None
-    
     ## cospliced_isoforms: the number of co-spliced isoforms in treatment
-    dfC_cospliced = sub_dfT.query('relative_abundance != 0')    
-    cospliced_isoforms = len(dfC_cospliced)
-    
-    # Reset to save memory
-    sub_dfT = None
-    dfC_cospliced = None
+    # Both are counted in process_diffRA from the pattern table of nonzero isoforms
     
     ## (depreciated) RA_cont_spliced_isoform: equals to sum of exon2:presence2 (control)
     # If the relative abundance of the splice isoform in control is zero
@@ -426,187 +819,789 @@ def calc_diffRA(df_treatment, df_control, exon1, exon2, presence1, presence2, df
 class ReplicateDetected(Exception):
     pass
 
-# Function to calculate "diff_relative_abundance", "splicing_type"
-##check using df_sub instead of df other than in input and df.query
-def process_diffRA(df, EU, cell_type, trmt, df_final):
-    # Subset df by EU and cell_type
-    df_sub = df.query(f'expt_unit=="{EU}" & cell_line=="{cell_type}"').reset_index(drop=True)    
-    
-    ## Label exon column cells by their actual exon names
-    
-    # Get list of exons and fill up empty exon columns with nan 
-    exon_list = list(set(df_sub['exons']))[0].replace(' ', '').split(',')
-    exon_list = ['E' + str(x) for x in exon_list]
-    col_len = len(df_sub.columns[5:-3])   
-    if len(exon_list) < col_len:
-        exon_list += [NaN]* (col_len - len(exon_list))
-    
-    # Rename exon columns
-    new_col_names = ["expt_unit", "cell_line", "treatment", "isoform", "exons"] + \
-        exon_list + ["replicate_ID", "relative_abundance", "replicates"]
-    df_sub.columns = new_col_names
-    
-    ### Trim exon columns to remove columns without any splicing activity
-    
-    # Check which exon column has no splicing activity and drop them
-    col = list(df_sub.columns)[5:-3]
-    col = [x for x in col if pd.isnull(x) != True]
-    
-    del_list = ["replicate_ID"]
-    for i in col:
-        # Check if exon column always have the same value or
-        # if exon column values have na
-        if df_sub[i].isnull().values.any() or len(set(df_sub[i])) == 1: 
-            del_list += [i]    
-    df_sub = df_sub.drop(del_list, axis=1)
-    
-    # Drop columns with all NaN values
-    df_sub = df_sub.dropna(axis=1, how='all')
-    try:
-        df_sub['replicates']
-    except KeyError:
-        df_sub.insert(len(df_sub.columns),'replicates', NaN)
+# An experimental unit (expt_unit and cell_line) prepared once and shared by
+# all of its treatments. The exon columns are labelled and pruned, and the
+# control side is cached: the bitmask pattern codes of the control isoforms 
+# and, for every exon pair pattern, the summed relative abundance, the number
+# of nonzero isoforms and the per-replicate sums (replicate_mean) of the 
+# control. Each treatment then only computes its own side in process().
+# control_name is the name of the control under "treatment"; rows (optional)
+# are the row positions of the unit in df from make_trmt_list. order is the 
+# largest number of exons in a set examined (2: exon pairs only).
+class PreparedUnit:
+    def __init__(self, df, EU, cell_type, control_name, rows=None, order=2):
+        self.EU = EU
+        self.cell_type = cell_type
+        self.order = order
         
-    ### Get treatment df_sub, reset index
-    dfT = df_sub.query(f'expt_unit=="{EU}" & cell_line=="{cell_type}" \
-                   & treatment=="{trmt}"').reset_index(drop=True)
-    
-    ### Get control df_sub, reset index
-    dfC = df_sub.query(f'expt_unit=="{EU}" & cell_line=="{cell_type}" \
-                       & treatment=="{control_name}"').reset_index(drop=True)
-    
-    # Check if control is present.
-    if len(dfC.index.values) == 0:
-        print(f"Error: Control for expt_unit: '{EU}', cell_line: '{cell_type}',  treatment: '{trmt}' is not found.")
-        print("Please include the control or ensure that the control name in input datasheet matches control_name user parameter.")
-        ##check Perhaps can improve by allowing programme to continue but giving NA for this {EU}/ {cell_type}/ {trmt}
-        sys.exit("Missing control")
-    
-    ### Make list of all possible exon pairs by combination (order does not
-    #   matter)
-    exon_pair_list = list(df_sub.columns)[5:-2]
-    combi = list(combinations(exon_pair_list, r=2))
-
-    ### If all row values are the same except for RA, then we have biological 
-    #   replicates. Find mean and use it to calculate RA_diff (for n >= 2)
-    #   Use datapoints to conduct pairwise test and give p-value (for n >= 3)
-    
-    # Data structure of exon1, exon2 presence/ absence and the type of co-
-    # splicing they can undergo
-    possibilities = ( ('1', '1', "co-exclusion"), 
-                       ('0', '0', "co-inclusion"),
-                       ('1', '0', "exchange"), 
-                       ('0', '1', "exchange") )
-    
-    # For exon1 and exon2 in combinations of all exons
-    for e1, e2 in combi:
-        # For each e1-e2, there are four possible types of presence1-presence2
-        # in control, which if present, associates with a type of co-splicing
-        for p1C, p2C, splice_type in possibilities:
-            # Reset all variables
-            E_stat = None
-            E_p = None
-            N_stat1 = None
-            N_p1 = None
-            N_stat2 = None
-            N_p2 = None
-            u = None
-            p = None
-            out = None
-            dfCont = None
-            dfTreat = None
+        # Subset df by EU and cell_type
+        if rows is None:
+            df_sub = df[(df["expt_unit"] == EU) & (df["cell_line"] == cell_type)].reset_index(drop=True)
+        else:
+            df_sub = df.iloc[rows].reset_index(drop=True)
+        
+        ## Label exon column cells by their actual exon names
+    
+        # Get list of exons and fill up empty exon columns with nan. Exon 
+        # columns run up to replicate_ID; the columns after it are 
+        # relative_abundance and the replicates ("replicates", or the packed
+        # columns of a compact datasheet)
+        exon_list = list(set(df_sub['exons']))[0].replace(' ', '').split(',')
+        exon_list = ['E' + str(x) for x in exon_list]
+        col_len = list(df_sub.columns).index("replicate_ID") - 5
+        if len(exon_list) < col_len:
+            exon_list += [NaN]* (col_len - len(exon_list))
+    
+        # Rename exon columns
+        new_col_names = ["expt_unit", "cell_line", "treatment", "isoform", "exons"] + \
+            exon_list + list(df_sub.columns[5 + col_len:])
+        df_sub.columns = new_col_names
+    
+        ### Trim exon columns to remove columns without any splicing activity
+    
+        # Check which exon column has no splicing activity and drop them
+        col = list(df_sub.columns)[5:5 + col_len]
+        col = [x for x in col if pd.isnull(x) != True]
+    
+        del_list = ["replicate_ID"]
+        for i in col:
+            # Check if exon column always have the same value or
+            # if exon column values have na
+            if df_sub[i].isnull().values.any() or len(set(df_sub[i])) == 1: 
+                del_list += [i]    
+        df_sub = df_sub.drop(del_list, axis=1)
+    
+        # Drop columns with all NaN values
+        df_sub = df_sub.dropna(axis=1, how='all')
+        if not any(str(x).startswith("replicates") for x in df_sub.columns):
+            df_sub.insert(len(df_sub.columns),'replicates', NaN)
+        self.df_sub = df_sub
+        
+        ### Make list of all possible exon pairs by combination (order does not
+        #   matter)
+        self.exon_pair_list = list(df_sub.columns)[5:list(df_sub.columns).index("relative_abundance")]
+        self.combi = list(combinations(self.exon_pair_list, r=2))
+        self.pair_index = np.array(list(combinations(range(len(self.exon_pair_list)), r=2)), 
+                                   dtype=np.int64).reshape(-1, 2)
+        
+        ### Get control df_sub, reset index
+        self.dfC = df_sub[df_sub["treatment"] == control_name].reset_index(drop=True)
+        
+        # Dense replicate matrix of all rows of the unit, sliced by condition
+        self.rep = frame_replicate_matrix(df_sub)
+        
+        ### Encode exon presence of each control isoform as a bitmask and sum 
+        #   the relative abundance of every exon pair pattern at once
+        #   sumC[i, code]: RA of control isoforms with pattern code in pair i
+        #   nonzeroC[i, code]: number of those isoforms with nonzero RA
+        #   control[i][code]: (replicate_list, mean) of those isoforms
+        self.maskC = encode_exon_bitmask(self.dfC, self.exon_pair_list)
+        self.raC = self.dfC['relative_abundance'].to_numpy(dtype=float)
+        self.repC = self.rep[(df_sub["treatment"] == control_name).to_numpy()]
+        self.sumC, self.nonzeroC, repC = pattern_tables(self.maskC, self.raC, self.repC, 
+                                                        self.pair_index)
+        self.control = [[replicate_mean(repC[i, code], self.sumC[i, code]) for code in range(4)]
+                        for i in range(len(self.combi))]
+        
+        # Control pattern tables of larger exon sets, by set, as they are 
+        # needed by treatments (see control_tables)
+        self.set_tables = {}
+    
+    # Content hash of everything the results of treatment trmt depend on: the
+    # labelled and pruned rows of the treatment and of the control (so exon 
+    # names, exon columns kept, replicates and row order are included), 
+    # batch, the result format, the pruning thresholds of process (see 
+    # EventFilter) and, for tests run in process (batch False), exact_max. 
+    # Used as key of the result cache.
+    def cache_key(self, trmt, batch, keep_replicates=False, event_filter=None, exact_max=20):
+        if not hasattr(self, "control_text"):
+            self.control_text = self.dfC.to_csv(index=False)
+        dfT = self.df_sub[self.df_sub["treatment"] == trmt]
+        key = sha256()
+        parts = (cache_version, str(order_result_columns(self.order, keep_replicates)), str(batch), 
+                 dfT.to_csv(index=False), self.control_text)
+        if event_filter is not None:
+            parts += (event_filter.process_key(),)
+        if not batch:
+            parts += (str(exact_max),)
+        for part in parts:
+            key.update(part.encode())
+            key.update(b'\0')
+        return key.hexdigest()
+    
+    # Control pattern tables (sums, nonzero, rep_sums, see pattern_tables) of 
+    # the exon sets (list of tuples of exon positions) of k > 2 exons; tables of
+    # sets not seen by an earlier treatment are computed together and kept
+    def control_tables(self, exon_sets):
+        new_sets = [x for x in exon_sets if x not in self.set_tables]
+        if new_sets:
+            tables = pattern_tables(self.maskC, self.raC, self.repC, np.array(new_sets, dtype=np.int64))
+            for i, exon_set in enumerate(new_sets):
+                self.set_tables[exon_set] = tuple(table[i] for table in tables)
+        return tuple(np.array([self.set_tables[x][j] for x in exon_sets]) for j in range(3))
+    
+    # Calculate "diff_relative_abundance", "splicing_type" etc. of treatment 
+    # trmt against the cached control and add them to results (ResultCollector).
+    # If pending_tests is a list, pairwise tests are not run here; the row 
+    # position and replicate lists of every event that needs a test are 
+    # appended to it, and p-value is left as nan until batched_tests is run.
+    # Events below the magnitude and diff_relative_abundance thresholds of 
+    # event_filter (EventFilter, optional) are dropped before their tests.
+    # exact_max is passed to mannwhitneyu_p. Counts are added to counts 
+    # (Counter) if given.
+    def process(self, trmt, results, pending_tests=None, counts=None, event_filter=None,
+                exact_max=20):
+        EU = self.EU
+        cell_type = self.cell_type
+        debug = logger.isEnabledFor(logging.DEBUG)
+        skipped_control = 0
+        skipped_treatment = 0
+        sets_examined = 0
+        sets_pruned = 0
+        patterns_examined = 0
+        tests = Counter()
+        pruned = Counter()
+        rows_before = len(results)
+        
+        ### Get treatment df_sub, reset index
+        is_trmt = (self.df_sub["treatment"] == trmt).to_numpy()
+        dfT = self.df_sub[is_trmt].reset_index(drop=True)
+        
+        # Check if control is present.
+        if len(self.dfC.index.values) == 0:
+            logger.error(f"Error: Control for expt_unit: '{EU}', cell_line: '{cell_type}',  treatment: '{trmt}' is not found.")
+            logger.error("Please include the control or ensure that the control name in input datasheet matches control_name user parameter.")
+            ##check Perhaps can improve by allowing programme to continue but giving NA for this {EU}/ {cell_type}/ {trmt}
+            raise DatasheetError("Missing control")
+        
+        ### Pattern tables of the treatment (see __init__ for the control)
+        maskT = encode_exon_bitmask(dfT, self.exon_pair_list)
+        raT = dfT['relative_abundance'].to_numpy(dtype=float)
+        repmatT = self.rep[is_trmt]
+        
+        ### If all row values are the same except for RA, then we have biological 
+        #   replicates. Find mean and use it to calculate RA_diff (for n >= 2)
+        #   Use datapoints to conduct pairwise test and give p-value (for n >= 3)
+        
+        # Exon sets of k exons, from exon pairs (k = 2) up to self.order. Sets 
+        # of k > 2 exons are only examined if all of their subsets of k - 1 
+        # exons had an event (next_exon_sets)
+        exon_sets = [tuple(x) for x in self.pair_index]
+        for k in range(2, self.order + 1):
+            if k > 2:
+                n_sets = comb(len(self.exon_pair_list), k)
+                exon_sets = next_exon_sets(live_sets, k)
+                sets_pruned += n_sets - len(exon_sets)
+            if len(exon_sets) == 0:
+                break
+            sets_examined += len(exon_sets)
+            index = np.array(exon_sets, dtype=np.int64).reshape(-1, k)
+            if k == 2:
+                sumC, nonzeroC, repC = self.sumC, self.nonzeroC, None
+            else:
+                sumC, nonzeroC, repC = self.control_tables(exon_sets)
+            sumT, nonzeroT, repT = pattern_tables(maskT, raT, repmatT, index)
+            
+            # For each exon set, each presence pattern with nonzero RA in 
+            # control (codeC) associates with a type of co-splicing; there is an
+            # event if the co-spliced (complementary) pattern codeT has nonzero
+            # RA in treatment. Events are listed by set, then by pattern_order
+            full = 2**k - 1
+            order = pattern_order(k)
+            in_control = sumC[:, order] != 0
+            event = in_control & (sumT[:, full - order] != 0)
+            skipped_control += int((~in_control).sum())
+            skipped_treatment += int((in_control & ~event).sum())
+            patterns_examined += sumC.size
+            live_sets = [exon_sets[i] for i in np.flatnonzero(event.any(axis=1))]
+            event_sets, event_patterns = np.nonzero(event)
+            event_codesC = order[event_patterns]
+            event_codesT = full - event_codesC
+            
+            ## Calculate magnitude, mnt, of all events: distance between the
+            #  RA of the co-spliced form in treatment and the closest 
+            #  intermediate form (any other pattern of the set) in control
+            treatment_cospliced_RA = sumT[event_sets, event_codesT]
+            distance = np.abs(sumC[event_sets] - treatment_cospliced_RA[:, None])
+            distance[np.arange(len(event_sets)), event_codesC] = np.inf
+            distance[np.arange(len(event_sets)), event_codesT] = np.inf
+            magnitudes = distance.min(axis=1)
+            
+            # Early pruning: events below the magnitude threshold are not 
+            # calculated any further
+            if event_filter is not None and event_filter.min_magnitude is not None:
+                candidate = magnitudes >= event_filter.min_magnitude
+                pruned["events_pruned_magnitude"] += int((~candidate).sum())
+                event_sets, event_codesC, event_codesT, magnitudes = \
+                    event_sets[candidate], event_codesC[candidate], event_codesT[candidate], magnitudes[candidate]
             
-            # Check if unspliced isoform is present (nonzero RA) in control 
-            print(f"Examining exon {e1} ({p1C}) and exon {e2} ({p2C}) in control")
-            dfCont = dfC.query(f'{e1}=={p1C} & {e2}=={p2C}')
-            if sum(dfCont['relative_abundance']) != 0:
+            for s, codeC, codeT, mnt in zip(event_sets, event_codesC, event_codesT, magnitudes):
+                # Reset all variables
+                E_stat = None
+                E_p = None
+                N_stat1 = None
+                N_p1 = None
+                N_stat2 = None
+                N_p2 = None
+                u = None
+                p = None
+                out = None
+                
+                exons = [self.exon_pair_list[x] for x in exon_sets[s]]
+                if debug:
+                    presence = format(codeC, f"0{k}b")
+                    logger.debug("Examining " + " and ".join(f"exon {e} ({x})" for e, x in zip(exons, presence))
+                                 + " in control")
+                
                 ## Perform RA diff calculation between the co-spliced form of 
                 ## treatment and control
-                p1T = swap_dict[p1C]
-                p2T = swap_dict[p2C]
-                # Check if co-spliced isoform is present (nonzero RA) in treatment; 
-                # if present, run calc_diffRA
-                dfTreat = dfT.query(f'{e1}=={p1T} & {e2}=={p2T}')
-                if sum(dfTreat['relative_abundance']) != 0:
-                    out = calc_diffRA(dfT, dfC, e1, e2, p1T, p2T, dfCont)
-
-                    ## Pairwise tests
-                    # Possible inputs to the following conditionals:
-                        # If there are replicates: we have the sum of isoforms:
-                        #   e.g. [0.1, 0.1, 0.2]
-                        # If there are no replicates: nan
-                    try:
-                        if type(out[4]) == list:
-
-                            # If list has 1 or two items (not enough for pair-
-                            # wise test)
-                            if len(out[4]) <= 2:
-                                p = 1
-                                
-                            # If list has 3 or more replicates (do pairwise test)
-                            elif len(out[4]) >= 3:
-                                raise ReplicateDetected
-        
-                        # When there are no replicates, out[4] = nan
-                        elif pd.isna(out[4]):
+                if k == 2:
+                    control = self.control[s][codeT]
+                else:
+                    control = replicate_mean(repC[s, codeT], sumC[s, codeT])
+                out = calc_diffRA(replicate_mean(repT[s, codeT], sumT[s, codeT]), control,
+                                  nonzeroC[s, codeC], nonzeroT[s, codeT])
+                
+                # Early pruning: events below the diff_relative_abundance 
+                # threshold are neither tested nor scored
+                if event_filter is not None and event_filter.min_diff is not None \
+                        and not out[0] >= event_filter.min_diff:
+                    pruned["events_pruned_diff"] += 1
+                    continue
+                
+                ## Pairwise tests
+                # Possible inputs to the following conditionals:
+                    # If there are replicates: we have the sum of isoforms:
+                    #   e.g. [0.1, 0.1, 0.2]
+                    # If there are no replicates: nan
+                try:
+                    if type(out[4]) == list:
+
+                        # If list has 1 or two items (not enough for pair-
+                        # wise test)
+                        if len(out[4]) <= 2:
                             p = 1
-                            
-                        else:
-                            print("Error: unexpected input in process_diffRA")
-                            print(f"The input is {out[4]}")
-                            sys.exit()
-                    
-                    except ReplicateDetected:   
-                    # Perform Mann-Whitney U test if sample size is small
-                    # Non-parametric, unpaired test
-                        if len(out[4]) >= 3 and len(out[4]) < 30:
-                            u, p = mannwhitneyu(out[4], out[5], use_continuity=True, 
-                                             alternative='two-sided')
+                            tests["tests_skipped_few_replicates"] += 1
                         
-                        # When sample size exceeds 30, by Central Limit Theorem,
-                        # we might be able perform t-test; 
-                        # Check equal variance and normality assumption first
-                        elif len(out[4]) >= 30:
-                            # Check if variance is equal or not by Levene's test
-                            E_stat, E_p = levene(out[4], out[5], center='median', proportiontocut=0.05)
-                            N_stat1, N_p1 = normaltest(out[4], axis=0, nan_policy='propagate')
-                            N_stat2, N_p2 = normaltest(out[5], axis=0, nan_policy='propagate')
-                            # If equal variance and normal distribution, perform t-test
-                            if E_p > 0.05 and N_stat1 > 0.05 and N_stat2 > 0.05:
-                                u, p = ttest_ind(out[4], out[5],equal_var=True, nan_policy='propagate', 
-                                                 alternative='two-sided')
-                            # If unequal variance or not normal, perform Mann-Whitney
-                            else:
-                                u, p = mannwhitneyu(out[4], out[5], use_continuity=True, 
-                                             alternative='two-sided')
+                        # If list has 3 or more replicates (do pairwise test)
+                        elif len(out[4]) >= 3:
+                            raise ReplicateDetected
+
+                    # When there are no replicates, out[4] = nan
+                    elif pd.isna(out[4]):
+                        p = 1
+                        tests["tests_skipped_no_replicates"] += 1
                     
-                    ## Calculate magnitude, mnt
-                    treatment_cospliced_RA = sum(dfTreat['relative_abundance'])
-                    # Find the two intermediate forms; output is e.g. ( ('1','0'), ('0','1') )
-                    interm_forms = interm_dict[str(p1T) + str(p2T)]
-                    # Calculate RA for intermediate forms  
-                    p1a = interm_forms[0][0]
-                    p2a = interm_forms[0][1]
-                    p1b = interm_forms[1][0]
-                    p2b = interm_forms[1][1]
-                    control_intermediate_RA1 = sum(dfC.query(f'{e1}=={p1a} & {e2}=={p2a}')['relative_abundance'])
-                    control_intermediate_RA2 = sum(dfC.query(f'{e1}=={p1b} & {e2}=={p2b}')['relative_abundance'])
-                    # Calculate magnitude
-                    mnt = min(abs(control_intermediate_RA1-treatment_cospliced_RA), 
-                              abs(control_intermediate_RA2-treatment_cospliced_RA))
+                    else:
+                        raise ValueError(f"Unexpected input in process_diffRA: {out[4]}")
+            
+                except ReplicateDetected:   
+                # In batched mode, keep the replicate lists to test all 
+                # events of the run together
+                    if pending_tests is not None:
+                        pending_tests += [(len(results), out[4], out[5])]
+                        p = NaN
+                        tests["tests_batched"] += 1
                     
-                    # Update df_final
-                    df_final.loc[len(df_final)] = [EU,         # expt_unit
-                                                   trmt,       # treatment
-                                                   cell_type,  # cell_line
-                                                   e1, e2,     # control exon 1 & 2
-                                                   splice_type,# splicing type
-                                                   out[1],     # contributing isoforms in control
-                                                   out[2],     # cospliced isoforms in treatment
-                                                   p,          # p-value
-                                                   out[0],     # RA diff
-                                                   conf_calculator(out[1],out[2],p),
-                                                   mnt] # confidence score
+                # Without control replicates there is nothing to compare 
+                # against: untested, like too few replicates (as in 
+                # batched_tests)
+                    elif type(out[5]) != list:
+                        p = 1
+                        tests["tests_skipped_no_replicates"] += 1
+                    
+                # Perform Mann-Whitney U test if sample size is small
+                # Non-parametric, unpaired test
+                    elif len(out[4]) >= 3 and len(out[4]) < 30:
+                        p = mannwhitneyu_p(np.array([out[4]]), np.array([out[5]]), exact_max)[0]
+                        tests["tests_mannwhitneyu"] += 1
+                
+                    # When sample size exceeds 30, by Central Limit Theorem,
+                    # we might be able perform t-test; 
+                    # Check equal variance and normality assumption first
+                    elif len(out[4]) >= 30:
+                        from scipy.stats import ttest_ind, levene, normaltest
+                        # Check if variance is equal or not by Levene's test
+                        E_stat, E_p = levene(out[4], out[5], center='median', proportiontocut=0.05)
+                        N_stat1, N_p1 = normaltest(out[4], axis=0, nan_policy='propagate')
+                        N_stat2, N_p2 = normaltest(out[5], axis=0, nan_policy='propagate')
+                        # If equal variance and normal distribution, perform t-test
+                        if E_p > 0.05 and N_stat1 > 0.05 and N_stat2 > 0.05:
+                            u, p = ttest_ind(out[4], out[5],equal_var=True, nan_policy='propagate', 
+                                             alternative='two-sided')
+                            tests["tests_ttest"] += 1
+                        # If unequal variance or not normal, perform Mann-Whitney
+                        else:
+                            p = mannwhitneyu_p(np.array([out[4]]), np.array([out[5]]), exact_max)[0]
+                            tests["tests_mannwhitneyu"] += 1
+            
+                # Update results
+                results.add([EU,         # expt_unit
+                             trmt,       # treatment
+                             cell_type]  # cell_line
+                            + exons + [NaN] * (self.order - k) # control exons
+                            + [splicing_type(codeC, k), # splicing type
+                             out[1],     # contributing isoforms in control
+                             out[2],     # cospliced isoforms in treatment
+                             p,          # p-value
+                             out[0],     # RA diff
+                             conf_calculator(out[1],out[2],p), # confidence score
+                             mnt]        # magnitude
+                            + ([out[4], out[5]] if results.keep_replicates else []))
+        
+        if counts is not None:
+            counts["treatments_calculated"] += 1
+            counts["exon_sets_examined"] += sets_examined
+            counts["exon_sets_pruned"] += sets_pruned
+            counts["patterns_examined"] += patterns_examined
+            counts["patterns_skipped_zero_control_RA"] += skipped_control
+            counts["patterns_skipped_zero_treatment_RA"] += skipped_treatment
+            counts["rows_emitted"] += len(results) - rows_before
+            counts.update(tests)
+            counts.update(pruned)
+
+# Function to calculate "diff_relative_abundance", "splicing_type"
+# for one treatment; prepares its experimental unit from df, or from its row
+# positions in df (unit_rows of make_trmt_list). To run several treatments
+# of one unit, prepare the unit once with PreparedUnit instead.
+def process_diffRA(df, EU, cell_type, trmt, control_name, results, pending_tests=None, rows=None,
+                   order=2):
+    PreparedUnit(df, EU, cell_type, control_name, rows, order).process(trmt, results, pending_tests)
+
+# Columns of the output dataframe (df_final) and their dtypes
+result_columns = (("expt_unit", object), 
+                  ("treatment", object), 
+                  ("cell_line", object),
+                  ("control_exon1", object), ("control_exon2", object), 
+                  ("splicing_type", object), 
+                  ("contributing_isoforms_count", np.int64),
+                  ("cospliced_isoforms", np.int64),
+                  ("p-value", np.float64),
+                  ("diff_relative_abundance", np.float64),                                    
+                  ("confidence_score", np.float64),
+                  ("magnitude", np.float64))
+
+# Columns of df_final for exon sets of up to order exons: control_exon3 ... 
+# are added after control_exon2 (nan for smaller sets). With keep_replicates,
+# the replicate lists of the treatment and control are kept at the end of 
+# every row for resampling (see resample_ci, which removes them).
+def order_result_columns(order, keep_replicates=False):
+    extra = tuple((f"control_exon{i}", object) for i in range(3, order + 1))
+    replicates = (("treatment_replicates", object), ("control_replicates", object))
+    return result_columns[:5] + extra + result_columns[5:] + (replicates if keep_replicates else ())
+
+# Collector for storing output: rows are appended column by column (one list
+# per column) and df_final is built once with to_frame(), instead of 
+# enlarging a dataframe one row at a time
+class ResultCollector:
+    def __init__(self, order=2, keep_replicates=False):
+        self.order = order
+        self.keep_replicates = keep_replicates
+        self.result_columns = order_result_columns(order, keep_replicates)
+        self.columns = {name: [] for name, dtype in self.result_columns}
+    
+    def __len__(self):
+        return len(self.columns["expt_unit"])
+    
+    # Add one row, with values in the order of result_columns
+    def add(self, row):
+        for values, value in zip(self.columns.values(), row):
+            values.append(value)
+    
+    # Append all rows of another collector
+    def extend(self, other):
+        for name, values in self.columns.items():
+            values.extend(other.columns[name])
+    
+    # New collector with the rows at positions rows, in that order
+    def select(self, rows):
+        selected = ResultCollector(self.order, self.keep_replicates)
+        for name, values in self.columns.items():
+            selected.columns[name] = [values[row] for row in rows]
+        return selected
+    
+    # Build df_final with the columns and dtypes of result_columns
+    def to_frame(self):
+        frame = {}
+        for name, dtype in self.result_columns:
+            if dtype == object:
+                # Element-wise, so that replicate lists stay one list per row
+                frame[name] = np.empty(len(self), dtype=object)
+                frame[name][:] = self.columns[name]
+            else:
+                frame[name] = np.array(self.columns[name], dtype=dtype)
+        return pd.DataFrame(frame)
+
+## Early pruning
+# Thresholds that drop events before the expensive steps, so that large 
+# screens only test and score the events of interest. Events with 
+# diff_relative_abundance below min_diff or magnitude below min_magnitude 
+# are dropped in PreparedUnit.process before their pairwise tests (min_diff 
+# = 0 drops the events that finalize_results filters out anyway). Events 
+# with a raw p-value above max_p are dropped after their test, and with 
+# top_k only the top_k events of every experimental unit with the highest
+# confidence scores (from raw p-values) are kept, selected with a bounded 
+# heap; both are applied per unit (select_unit). None disables a threshold.
+# Dropped events are not part of the Benjamini-Hochberg adjustment.
+class EventFilter:
+    def __init__(self, min_diff=None, min_magnitude=None, max_p=None, top_k=None):
+        self.min_diff = min_diff
+        self.min_magnitude = min_magnitude
+        self.max_p = max_p
+        self.top_k = top_k
+    
+    # Thresholds applied in PreparedUnit.process, part of the result cache 
+    # key (see cache_key)
+    def process_key(self):
+        return str((self.min_diff, self.min_magnitude))
+    
+    # Apply max_p and top_k to the results of one experimental unit (list of
+    # (ResultCollector, pending_tests), one per treatment, see process_unit)
+    # and return them with the rows kept, in their order. Both need p-values,
+    # so the pending tests of the unit are run here (batched_tests, with 
+    # exact_max). Tests run and events dropped are added to counts (Counter)
+    # if given.
+    def select_unit(self, results, counts=None, exact_max=20):
+        if self.max_p is None and self.top_k is None:
+            return results
+        counts = Counter() if counts is None else counts
+        for collector, pending_tests in results:
+            if pending_tests:
+                columns = collector.columns
+                p = batched_tests([(x, y) for row, x, y in pending_tests], counts, exact_max)
+                for (row, x, y), p_row in zip(pending_tests, p):
+                    columns["p-value"][row] = p_row
+                    columns["confidence_score"][row] = conf_calculator(
+                        columns["contributing_isoforms_count"][row], columns["cospliced_isoforms"][row], p_row)
+        
+        # Rows of every treatment at or below max_p (events without a p-value
+        # are dropped)
+        kept = []
+        for collector, pending_tests in results:
+            p = collector.columns["p-value"]
+            if self.max_p is None:
+                kept += [list(range(len(collector)))]
+            else:
+                kept += [[row for row in range(len(collector)) if p[row] <= self.max_p]]
+                counts["events_pruned_p_value"] += len(collector) - len(kept[-1])
+        
+        # Top top_k rows by confidence score in a min-heap of at most top_k 
+        # items; of equal scores the first events are kept
+        if self.top_k is not None:
+            heap = []
+            position = 0
+            for i, rows in enumerate(kept):
+                scores = results[i][0].columns["confidence_score"]
+                for row in rows:
+                    score = scores[row] if scores[row] == scores[row] else -np.inf
+                    item = (score, -position, i, row)
+                    position += 1
+                    if len(heap) < self.top_k:
+                        heappush(heap, item)
+                    else:
+                        heappushpop(heap, item)
+            counts["events_pruned_top_k"] += position - len(heap)
+            kept = [[] for rows in kept]
+            for score, rank, i, row in sorted(heap, key=lambda item: -item[1]):
+                kept[i] += [row]
+        
+        dropped = sum(len(collector) for collector, pending_tests in results) - sum(len(rows) for rows in kept)
+        counts["rows_emitted"] -= dropped
+        return [(collector.select(rows), None if pending_tests is None else [])
+                for (collector, pending_tests), rows in zip(results, kept)]
+
+# EventFilter of the pruning parameters (see EventFilter), or None if they are
+# all None. top_k ranks events by confidence scores of raw p-values, so it 
+# needs p_value_for_confidence = "raw".
+def make_event_filter(min_diff=None, min_magnitude=None, max_p=None, top_k=None, 
+                      p_value_for_confidence="raw"):
+    if min_diff is None and min_magnitude is None and max_p is None and top_k is None:
+        return None
+    if top_k is not None:
+        if type(top_k) != int or top_k < 1:
+            raise ParameterError("Parameter Error: top_k_events must be a positive integer or None.")
+        if p_value_for_confidence != "raw":
+            raise ParameterError("Parameter Error: top_k_events ranks events by confidence scores of raw p-values; use p_value_for_confidence = 'raw'.")
+    return EventFilter(min_diff, min_magnitude, max_p, top_k)
+
+## Result cache
+# Results of each treatment (its ResultCollector columns and pending tests)
+# are pickled to cache_directory under the content hash of its inputs 
+# (PreparedUnit.cache_key), so a re-run only calculates treatments whose 
+# rows, control rows or exon columns changed. Files are least recently used
+# first out: a hit refreshes the modification time, and evict_cache removes 
+# the oldest files above the size cap. Bump cache_version when the 
+# calculation changes so old entries are not reused.
+cache_version = "1"
+
+# Return (results, pending_tests) cached under key, or None if not cached 
+# (or the file cannot be read)
+def load_cached_result(cache_directory, key, order=2, keep_replicates=False):
+    path = join(cache_directory, key + ".pkl")
+    try:
+        with open(path, "rb") as file:
+            columns, pending_tests = pickle.load(file)
+        utime(path)
+    except Exception:
+        return None
+    results = ResultCollector(order, keep_replicates)
+    results.columns = columns
+    return results, pending_tests
+
+# Cache (results, pending_tests) under key. The file is written under a 
+# temporary name and renamed, so worker processes never read a partial file
+def store_cached_result(cache_directory, key, results, pending_tests):
+    with NamedTemporaryFile(dir=cache_directory, suffix=".tmp", delete=False) as file:
+        pickle.dump((results.columns, pending_tests), file, protocol=pickle.HIGHEST_PROTOCOL)
+    replace(file.name, join(cache_directory, key + ".pkl"))
+
+# Remove least recently used cache files until the cache is at most 
+# size_limit megabytes. Files removed meanwhile by another process sharing
+# the cache (e.g. jobs of csi_server.py) are skipped.
+def evict_cache(cache_directory, size_limit):
+    entries = []
+    for name in listdir(cache_directory):
+        if name.endswith(".pkl"):
+            try:
+                info = stat(join(cache_directory, name))
+            except FileNotFoundError:
+                continue
+            entries += [(info.st_mtime, info.st_size, name)]
+    total = sum(size for mtime, size, name in entries)
+    for mtime, size, name in sorted(entries):
+        if total <= size_limit * 1024**2:
+            break
+        try:
+            remove(join(cache_directory, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+# Run process_diffRA for the treatments of one experimental unit (expt_unit 
+# and cell_line), given only the rows of that unit. The unit is prepared once
+# and each treatment fills its own ResultCollector, so units can run in 
+# separate processes. With a cache_directory, treatments found in the result
+# cache are not calculated again. Events are pruned with event_filter 
+# (EventFilter, optional), whose p-value threshold and top k apply to all 
+# treatments of the unit together. exact_max is passed to mannwhitneyu_p.
+# Returns a list of (results, pending_tests), one per treatment, and the 
+# counts (Counter) of the unit.
+def process_unit(task):
+    (df_unit, EU, cell_type, trmts, control_name, batch, cache_directory, order, keep_replicates,
+     event_filter, exact_max) = task
+    unit = PreparedUnit(df_unit, EU, cell_type, control_name, np.arange(len(df_unit)), order)
+    results = []
+    counts = Counter()
+    for trmt in trmts:
+        logger.info(f'Calculating for experiment unit "{EU}", cell line "{cell_type}" and treatment "{trmt}"')
+        key = cached = None
+        if cache_directory is not None and len(unit.dfC.index.values) > 0:
+            key = unit.cache_key(trmt, batch, keep_replicates, event_filter, exact_max)
+            cached = load_cached_result(cache_directory, key, order, keep_replicates)
+        if cached is None:
+            collector = ResultCollector(order, keep_replicates)
+            pending_tests = [] if batch else None
+            unit.process(trmt, collector, pending_tests, counts, event_filter, exact_max)
+            if key is not None:
+                store_cached_result(cache_directory, key, collector, pending_tests)
+            results += [(collector, pending_tests)]
+            logger.info("Completed")
+        else:
+            results += [cached]
+            counts["treatments_cached"] += 1
+            counts["rows_emitted"] += len(cached[0])
+            logger.info("Completed (cached)")
+    if event_filter is not None:
+        results = event_filter.select_unit(results, counts, exact_max)
+    return results, counts
+
+# Run all treatments in treatment_list, in this process (workers = 1) or 
+# sharded by experimental unit across a pool of worker processes. Each worker
+# receives the rows of its unit only, sliced with unit_rows from 
+# make_trmt_list (unit_frame). Results are merged in the order of treatment_list, so 
+# df_final (rows, index and pending test rows) is the same for any number of
+# workers.
+# An existing pool can be passed to reuse its processes across calls. 
+# cache_directory (optional) is the directory of the result cache. Counts of
+# all units are added to counts (Counter) if given. order is the largest 
+# number of exons in a set examined (see PreparedUnit); keep_replicates keeps
+# the replicate lists of every row for resample_ci. event_filter (EventFilter,
+# optional) prunes events early; exact_max is passed to mannwhitneyu_p.
+def run_treatments(df, treatment_list, unit_rows, control_name, workers=1, batch=True, pool=None,
+                   cache_directory=None, counts=None, order=2, keep_replicates=False, 
+                   event_filter=None, exact_max=20):
+    # Put results back in the order of treatment_list
+    result_of = {}
+    for key, trmts, results in iter_unit_results(df, treatment_list, unit_rows, control_name, 
+                                                 workers, batch, pool, cache_directory, counts,
+                                                 order, keep_replicates, 0, event_filter,
+                                                 exact_max):
+        for trmt, result in zip(trmts, results):
+            result_of[key + (trmt,)] = result
+    return merge_results([result_of[x] for x in treatment_list], batch, order, keep_replicates)
+
+# Experimental units of treatment_list, as {(EU, cell_type): [treatments]} in 
+# order of first appearance
+def unit_treatments(treatment_list):
+    unit_trmts = {}
+    for EU, cell_type, trmt in treatment_list:
+        unit_trmts.setdefault((EU, cell_type), []).append(trmt)
+    return unit_trmts
+
+# Run the experimental units of treatment_list one at a time (see 
+# run_treatments for the arguments), skipping the first start units, and 
+# yield ((EU, cell_type), treatments, results) for every unit in order as 
+# soon as it is done; results holds (ResultCollector, pending_tests) per 
+# treatment. Counts of the unit are added to counts (Counter) if given.
+def iter_unit_results(df, treatment_list, unit_rows, control_name, workers=1, batch=True, pool=None,
+                      cache_directory=None, counts=None, order=2, keep_replicates=False, start=0,
+                      event_filter=None, exact_max=20):
+    units = list(unit_treatments(treatment_list).items())[start:]
+    if cache_directory is not None:
+        try:
+            mkdir(cache_directory)
+        except FileExistsError:
+            pass
+    tasks = ((unit_frame(df, unit_rows[key]), key[0], key[1], trmts, control_name, batch, cache_directory,
+              order, keep_replicates, event_filter, exact_max) for key, trmts in units)
+    
+    own_pool = pool is None and workers > 1
+    if own_pool:
+        pool = Pool(workers)
+    try:
+        unit_results = pool.imap(process_unit, tasks) if pool is not None else map(process_unit, tasks)
+        for (key, trmts), (results, unit_counts) in zip(units, unit_results):
+            if counts is not None:
+                counts.update(unit_counts)
+            yield key, trmts, results
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+
+# Merge (ResultCollector, pending_tests) results into (df_final, 
+# pending_tests), shifting pending test rows to their position in df_final
+def merge_results(results, batch=True, order=2, keep_replicates=False):
+    collector = ResultCollector(order, keep_replicates)
+    pending_tests = [] if batch else None
+    for collector_part, pending_part in results:
+        if batch:
+            pending_tests += [(row + len(collector), replicatesT, replicatesC) 
+                              for row, replicatesT, replicatesC in pending_part]
+        collector.extend(collector_part)
+    
+    return collector.to_frame(), pending_tests
+
+# Read the datasheet in chunks of chunksize rows and spill its rows to bucket
+# CSV files in spill_dir, keyed by a stable hash (crc32) of expt_unit, so that
+# every experimental unit ends up whole in one bucket whatever the order of 
+# the input. The number of buckets is chosen from the number of rows so that
+# a bucket holds about chunksize rows. Rows keep their row number in the 
+# datasheet as index (first column of the bucket files), so that validation 
+# reports refer to the whole datasheet. Returns the bucket files.
+def spill_datasheet(file_name, spill_dir, chunksize):
+    bucket_files = []
+    offset = 0
+    for chunk in iter_datasheet_chunks(file_name, chunksize):
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+        offset += len(chunk)
+        if len(bucket_files) == 0:
+            check_exon_columns(chunk.columns)
+            n_buckets = estimate_datasheet_rows(file_name, chunk) // chunksize + 1
+            bucket_files = [join(spill_dir, f"bucket_{i}.csv") for i in range(n_buckets)]
+            for path in bucket_files:
+                chunk.iloc[:0].to_csv(path)
+        
+        bucket = [crc32(str(EU).encode()) % len(bucket_files) for EU in chunk["expt_unit"]]
+        for i, rows in chunk.groupby(bucket, sort=False):
+            rows.to_csv(bucket_files[i], mode='a', header=False)
+    return bucket_files
+
+# Streaming mode: calculate CSI for the datasheet without loading it whole.
+# Rows are spilled to buckets of whole experimental units on disk 
+# (spill_datasheet), then each bucket is read, its replicates merged and its
+# treatments run, and it is released before the next bucket. Peak memory is 
+# bounded by the largest bucket (about chunksize rows, or the largest unit)
+# instead of the whole datasheet. Returns (df_final, pending_tests) like 
+# run_treatments; rows are ordered by bucket, then by first appearance. With
+# compact, each bucket is held in the representation of compact_datasheet.
+def run_streaming(file_name, control_name, chunksize, workers=1, batch=True, spill_directory=None,
+                  cache_directory=None, counts=None, report_path=None, order=2, keep_replicates=False,
+                  compact=False, event_filter=None, exact_max=20):
+    frames = []
+    pending_tests = [] if batch else None
+    n_rows = 0
+    with spilled_buckets(file_name, control_name, chunksize, workers, spill_directory, 
+                         report_path) as (bucket_files, pool):
+        for path in bucket_files:
+            df, treatment_list, unit_rows = read_bucket(path, control_name, compact, counts)
+            df_part, pending_part = run_treatments(df, treatment_list, unit_rows, control_name,
+                                                   workers, batch, pool, cache_directory,
+                                                   counts, order, keep_replicates, event_filter,
+                                                   exact_max)
+            df = None
+            if batch:
+                pending_tests += [(row + n_rows, replicatesT, replicatesC) 
+                                  for row, replicatesT, replicatesC in pending_part]
+            frames += [df_part]
+            n_rows += len(df_part)
+    
+    if len(frames) == 0:
+        return ResultCollector(order, keep_replicates).to_frame(), pending_tests
+    return pd.concat(frames, ignore_index=True), pending_tests
+
+# Spill the datasheet to buckets of whole experimental units in a temporary
+# directory (spill_datasheet) and validate every bucket before any 
+# calculation; gives (bucket_files, pool), with a pool of worker processes 
+# shared by all buckets if workers > 1 (else None)
+@contextmanager
+def spilled_buckets(file_name, control_name, chunksize, workers=1, spill_directory=None, 
+                    report_path=None):
+    with TemporaryDirectory(dir=spill_directory) as spill_dir:
+        logger.info("Spilling datasheet to disk by experimental unit")
+        bucket_files = spill_datasheet(file_name, spill_dir, chunksize)
+        
+        # Validate every bucket (whole experimental units) before calculating
+        # and report the problems as for the whole datasheet
+        logger.info("Validating datasheet")
+        check_datasheet(merge_issues(validate_datasheet(pd.read_csv(path, index_col=0), control_name)
+                                     for path in bucket_files), report_path)
+        
+        pool = Pool(workers) if workers > 1 else None
+        try:
+            yield bucket_files, pool
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+# Read a bucket file, merge its replicates (and compact it) and list its 
+# treatments: (df, treatment_list, unit_rows)
+def read_bucket(path, control_name, compact=False, counts=None):
+    df = preprocess(pd.read_csv(path, index_col=0))
+    if compact:
+        df = compact_datasheet(df, counts)
+    return (df,) + make_trmt_list(df, control_name)
+
+# Streaming counterpart of iter_unit_results: yield the results of every 
+# experimental unit, bucket by bucket, skipping the first start units (see 
+# run_streaming for the arguments)
+def iter_streaming_units(file_name, control_name, chunksize, workers=1, batch=True, 
+                         spill_directory=None, cache_directory=None, counts=None, report_path=None,
+                         order=2, keep_replicates=False, compact=False, start=0, 
+                         event_filter=None, exact_max=20):
+    done = 0
+    with spilled_buckets(file_name, control_name, chunksize, workers, spill_directory, 
+                         report_path) as (bucket_files, pool):
+        for path in bucket_files:
+            df, treatment_list, unit_rows = read_bucket(path, control_name, compact, counts)
+            n_units = len(unit_treatments(treatment_list))
+            if done + n_units > start:
+                yield from iter_unit_results(df, treatment_list, unit_rows, control_name, workers,
+                                             batch, pool, cache_directory, counts, order, 
+                                             keep_replicates, max(0, start - done), event_filter,
+                                             exact_max)
+            done += n_units
 
 def conf_calculator(contributing_isoforms, cospliced_isoforms, p): 
     a = 1/(contributing_isoforms)   
@@ -616,23 +1611,325 @@ def conf_calculator(contributing_isoforms, cospliced_isoforms, p):
         c = 50
     return ((a+b) * 25) + (c * 10)
 
-def plot(df_final, plot_name, directory):
-    fig = px.scatter(df_final, 
-                     x="magnitude", 
-                     y="diff_relative_abundance", 
-                     color="expt_unit", 
-                     size = "confidence_score",
-                     hover_data=['index'],
-                     title="Co-Splicing Index",
-                     labels={
-                         "magnitude": "Magnitude",
-                         "diff_relative_abundance": "Difference in relative abundance of co-spliced isoform (treatment - control)",
-                         "expt_unit": "Gene or experimental unit"},
-                     template='seaborn')
-    
-    fig.update_traces(marker=dict(line=dict(width=2,
-                                            color='DarkSlateGrey')),
-                  selector=dict(mode='markers'))
+# Levene's test with center='median' (Brown-Forsythe) for two samples along
+# axis 1, i.e. one test per row of x and y; returns p-values
+def levene_median(x, y):
+    from scipy.stats import f as f_distribution
+    n = x.shape[1] + y.shape[1]
+    zx = np.abs(x - np.median(x, axis=1, keepdims=True))
+    zy = np.abs(y - np.median(y, axis=1, keepdims=True))
+    zx_bar = zx.mean(axis=1)
+    zy_bar = zy.mean(axis=1)
+    z_bar = (zx_bar * x.shape[1] + zy_bar * y.shape[1]) / n
+    numer = (n - 2) * (x.shape[1] * (zx_bar - z_bar)**2 + y.shape[1] * (zy_bar - z_bar)**2)
+    denom = ((zx - zx_bar[:, None])**2).sum(axis=1) + ((zy - zy_bar[:, None])**2).sum(axis=1)
+    return f_distribution.sf(numer / denom, 1, n - 2)
+
+## Exact Mann-Whitney U tests
+# Null distributions of the Mann-Whitney U statistic by (m, n), the numbers
+# of values of the two samples, as cumulative probabilities; each is built 
+# once per process (mwu_null_cdf)
+mwu_null_tables = {}
+
+# Cumulative null distribution cdf[k] = P(U <= k) of the Mann-Whitney U 
+# statistic of samples of m and n values without ties. The numbers of 
+# orderings with U = k are the coefficients of the Gaussian binomial 
+# coefficient [m + n choose m] in q, the product of (1 - q^(n + i)) / 
+# (1 - q^i) for i = 1 ... m, computed with integers. Probabilities are summed
+# like scipy's exact method, so p-values are the same as scipy's.
+def mwu_null_cdf(m, n):
+    if (m, n) not in mwu_null_tables:
+        total = comb(m + n, m)
+        counts = np.zeros(m * n + 1, dtype=np.int64 if total < 2**62 else object)
+        counts[0] = 1
+        for i in range(1, m + 1):
+            # Multiply by 1 - q^(n + i), then divide by 1 - q^i (coefficients 
+            # above m * n are not needed)
+            counts[n + i:] = counts[n + i:] - counts[:len(counts) - n - i]
+            for k in range(i, len(counts)):
+                counts[k] += counts[k - i]
+        mwu_null_tables[(m, n)] = np.cumsum(counts.astype(np.float64) / float(total))
+    return mwu_null_tables[(m, n)]
+
+# Two-sided Mann-Whitney U test p-values of x and y (2-D arrays with one 
+# test per row, of m and n replicates). Tests without ties, with m and n at 
+# most exact_max, are exact: U from the ranks of the row, looked up in the 
+# cached null distribution (mwu_null_cdf). Tests with ties or more 
+# replicates, or all tests if exact_max is None, use scipy's mannwhitneyu 
+# with continuity correction as before (normal approximation with tie 
+# correction; exact without ties if a sample has at most 8 values).
+def mannwhitneyu_p(x, y, exact_max=20):
+    m, n = x.shape[1], y.shape[1]
+    p = np.empty(len(x))
+    xy = np.concatenate([x, y], axis=1)
+    if exact_max is not None and max(m, n) <= exact_max:
+        ordered = np.sort(xy, axis=1)
+        exact = ~(ordered[:, 1:] == ordered[:, :-1]).any(axis=1)
+    else:
+        exact = np.zeros(len(x), dtype=bool)
+    
+    if exact.any():
+        ranks = xy[exact].argsort(axis=1).argsort(axis=1) + 1
+        U1 = ranks[:, :m].sum(axis=1) - m * (m + 1) // 2
+        U = np.maximum(U1, m * n - U1)
+        p[exact] = np.minimum(2 * mwu_null_cdf(m, n)[m * n - U], 1)
+    if not exact.all():
+        from scipy.stats import mannwhitneyu
+        p[~exact] = mannwhitneyu(x[~exact], y[~exact], use_continuity=True, alternative='two-sided',
+                                 axis=1)[1]
+    return p
+
+# Run the pairwise tests of many events in batched, axis-wise calls.
+# Given a list of (treatment_list, control_list), return their p-values.
+# Events are grouped by (number of treatment replicates, number of control
+# replicates, ties present), so each group is one 2-D array and scipy picks
+# the same method (exact or asymptotic) as in a call per event. The choice
+# between Mann-Whitney U (mannwhitneyu_p, with exact_max) and t-test follows
+# process_diffRA. Tests run by type are added to counts (Counter) if given.
+def batched_tests(tests, counts=None, exact_max=20):
+    counts = Counter() if counts is None else counts
+    p = np.full(len(tests), NaN)
+    groups = {}
+    for index, (treatment_list, control_list) in enumerate(tests):
+        # Without control replicates there is nothing to compare against:
+        # untested, like too few replicates (p = 1)
+        if type(control_list) != list:
+            p[index] = 1
+            counts["tests_skipped_no_replicates"] += 1
+            continue
+        ties = len(set(treatment_list + control_list)) < len(treatment_list) + len(control_list)
+        groups.setdefault((len(treatment_list), len(control_list), ties), []).append(index)
+    
+    for (nT, nC, ties), index in groups.items():
+        x = np.array([tests[j][0] for j in index])
+        y = np.array([tests[j][1] for j in index])
+        p_mwu = mannwhitneyu_p(x, y, exact_max)
+        if nT < 30:
+            p[index] = p_mwu
+            counts["tests_mannwhitneyu"] += len(index)
+        else:
+            from scipy.stats import ttest_ind, normaltest
+            # Check equal variance and normality before using t-test
+            E_p = levene_median(x, y)
+            N_stat1 = normaltest(x, axis=1)[0]
+            N_stat2 = normaltest(y, axis=1)[0]
+            p_t = ttest_ind(x, y, axis=1, equal_var=True, alternative='two-sided')[1]
+            use_t = (E_p > 0.05) & (N_stat1 > 0.05) & (N_stat2 > 0.05)
+            p[index] = np.where(use_t, p_t, p_mwu)
+            counts["tests_ttest"] += int(use_t.sum())
+            counts["tests_mannwhitneyu"] += len(index) - int(use_t.sum())
+    return p
+
+# Benjamini-Hochberg adjusted p-values (false discovery rate) of a list of 
+# p-values. Missing p-values (nan) are not tests: they stay nan and do not 
+# count in the number of tests.
+def benjamini_hochberg(p):
+    p = np.asarray(p, dtype=float)
+    adjusted = np.full(len(p), NaN)
+    tested = np.flatnonzero(~np.isnan(p))
+    n = len(tested)
+    order = tested[np.argsort(p[tested])]
+    ranked = p[order] * n / np.arange(1, n + 1)
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    adjusted[order] = np.minimum(ranked, 1)
+    return adjusted
+
+# Fill in p-values of pending batched tests (from run_treatments), with 
+# exact_max (see mannwhitneyu_p). Tests run are added to counts (Counter) if
+# given.
+def fill_pending_tests(df_final, pending_tests, counts=None, exact_max=20):
+    if pending_tests:
+        rows = [row for row, treatment_list, control_list in pending_tests]
+        tests = [(treatment_list, control_list) for row, treatment_list, control_list in pending_tests]
+        df_final.loc[rows, "p-value"] = batched_tests(tests, counts, exact_max)
+
+# Fill in p-values of pending batched tests, add the Benjamini-Hochberg 
+# adjusted p-value over all events of the run after "p-value", and compute 
+# confidence scores from the raw or adjusted p-value. Tests run are added to
+# counts (Counter) if given.
+def score_results(df_final, pending_tests=None, p_value_for_confidence="raw", counts=None,
+                  exact_max=20):
+    fill_pending_tests(df_final, pending_tests, counts, exact_max)
+    
+    df_final.insert(df_final.columns.get_loc("p-value") + 1, "adjusted_p-value",
+                    benjamini_hochberg(df_final["p-value"]))
+    
+    if p_value_for_confidence == "adjusted":
+        p_col = "adjusted_p-value"
+    elif p_value_for_confidence == "raw":
+        p_col = "p-value"
+    else:
+        raise ParameterError("Parameter Error: p_value_for_confidence must be 'raw' or 'adjusted'.")
+    df_final["confidence_score"] = [conf_calculator(a, b, p) for a, b, p in 
+                                    zip(df_final["contributing_isoforms_count"],
+                                        df_final["cospliced_isoforms"],
+                                        df_final[p_col])]
+
+# Resampling intervals of diff_relative_abundance, for df_final built with 
+# keep_replicates. Every row with at least 2 replicates in treatment and in
+# control gets n_resamples resampled differences of the replicate means:
+#   "bootstrap": replicates are drawn with replacement within treatment and 
+#       within control; ci_low and ci_high are the percentile interval
+#   "permutation": replicates are shuffled between treatment and control; 
+#       permutation_p-value is the two-sided p-value of diff_relative_abundance
+#       and ci_low, ci_high the interval diff_RA - null quantiles (location 
+#       shift model)
+# Rows with the same numbers of replicates share one set of draws, seeded by
+# seed and the numbers of replicates, as replicate weight matrices, so the 
+# resampled differences of a chunk of rows are a few array operations (summed
+# replicate by replicate rather than by a matrix product, whose rounding 
+# depends on the chunk). The result of a row depends only on its replicates 
+# and the seed, not on the other rows, row order or chunking (so shards of a
+# run can resample on their own). Chunks of rows hold at most chunk_mb 
+# megabytes of resampled differences. Columns are inserted after 
+# diff_relative_abundance; rows without replicates get nan. The replicate 
+# list columns are removed.
+def resample_ci(df_final, method="bootstrap", n_resamples=1000, level=0.95, seed=0, chunk_mb=64):
+    check_resampling(method, n_resamples, level, chunk_mb)
+    treatment = df_final.pop("treatment_replicates").to_numpy()
+    control = df_final.pop("control_replicates").to_numpy()
+    ci = np.full((len(df_final), 2), NaN)
+    p_perm = np.full(len(df_final), NaN)
+    diff = df_final["diff_relative_abundance"].to_numpy()
+    
+    groups = {}
+    for row, (x, y) in enumerate(zip(treatment, control)):
+        if type(x) == list and type(y) == list and len(x) >= 2 and len(y) >= 2:
+            groups.setdefault((len(x), len(y)), []).append(row)
+    
+    quantiles = [(1 - level) / 2, (1 + level) / 2]
+    chunk = max(1, int(chunk_mb * 1024**2 / 8 / n_resamples))
+    for (nT, nC), rows in sorted(groups.items()):
+        rng = np.random.default_rng([seed, nT, nC])
+        # Weight matrices (n_resamples x replicates): the resampled difference
+        # is the sum of replicates times weights
+        if method == "bootstrap":
+            weights = np.zeros((n_resamples, nT + nC))
+            draws = np.hstack([rng.integers(0, nT, (n_resamples, nT)), 
+                               nT + rng.integers(0, nC, (n_resamples, nC))])
+            np.add.at(weights, (np.arange(n_resamples)[:, None], draws), 1)
+            weights[:, :nT] /= nT
+            weights[:, nT:] /= -nC
+        else:
+            permutations = rng.permuted(np.tile(np.arange(nT + nC), (n_resamples, 1)), axis=1)
+            weights = np.where(permutations < nT, 1 / nT, -1 / nC)
+        
+        for start in range(0, len(rows), chunk):
+            part = rows[start:start + chunk]
+            values = np.array([treatment[row] + control[row] for row in part])
+            resampled = np.zeros((len(part), n_resamples))
+            for j in range(nT + nC):
+                resampled += values[:, j, None] * weights[:, j]
+            if method == "bootstrap":
+                ci[part] = np.quantile(resampled, quantiles, axis=1).T
+            else:
+                ci[part] = diff[part, None] - np.quantile(resampled, quantiles[::-1], axis=1).T
+                extreme = (np.abs(resampled) >= np.abs(diff[part, None]) - 1e-12).sum(axis=1)
+                p_perm[part] = (extreme + 1) / (n_resamples + 1)
+    
+    position = df_final.columns.get_loc("diff_relative_abundance") + 1
+    df_final.insert(position, "ci_low", ci[:, 0])
+    df_final.insert(position + 1, "ci_high", ci[:, 1])
+    if method == "permutation":
+        df_final.insert(position + 2, "permutation_p-value", p_perm)
+
+# Check the parameters of resample_ci
+def check_resampling(method, n_resamples, level, chunk_mb):
+    if method not in ("bootstrap", "permutation"):
+        raise ParameterError("Parameter Error: ci_method must be 'bootstrap', 'permutation' or None.")
+    if type(n_resamples) != int or n_resamples < 1:
+        raise ParameterError("Parameter Error: ci_resamples must be a positive integer.")
+    if type(level) not in (int, float) or not 0 < level < 1:
+        raise ParameterError("Parameter Error: ci_level must be a number between 0 and 1.")
+    if type(chunk_mb) not in (int, float) or not chunk_mb > 0:
+        raise ParameterError("Parameter Error: ci_chunk_mb must be a positive number.")
+
+# Filter out events with negative difference in relative abundance and put
+# a fresh index as first column ("index") of df_final for plotting purposes
+def finalize_results(df_final):
+    # Filter out negative relative abundance values
+    df_final = df_final.query('diff_relative_abundance >= 0')
+    
+    # Reset index
+    df_final = df_final.reset_index(drop=True)
+    # Put index as first column of dataframe for plotting purposes
+    return df_final.reset_index(level=0)
+
+# Calculate Co-Splicing Indices of a datasheet held in memory and return 
+# df_final, as the script would export it. df is the datasheet as read from 
+# file (columns expt_unit ... E1..En ... replicate_ID, relative_abundance) and 
+# is not modified. There is no global state, no change of working directory 
+# and no disk I/O, so compute_csi can be called repeatedly and concurrently 
+# in one process; plot() and export_datasheet() are optional separate steps.
+# The datasheet is validated first (validate_datasheet); its errors raise 
+# DatasheetError and invalid parameters ParameterError. The result cache is used only if a 
+# cache_directory is given.
+def compute_csi(df, control_name, workers=1, batch_tests=True, p_value_for_confidence="raw",
+                cache_directory=None, cache_size_limit=1024, co_splicing_order=2, ci_method=None,
+                ci_resamples=1000, ci_level=0.95, ci_seed=0, ci_chunk_mb=64, compact_dtypes=False,
+                min_diff_relative_abundance=None, min_magnitude=None, max_p_value=None, 
+                top_k_events=None, mwu_exact_max=20):
+    event_filter = make_event_filter(min_diff_relative_abundance, min_magnitude, max_p_value, 
+                                     top_k_events, p_value_for_confidence)
+    check_co_splicing_order(co_splicing_order)
+    if ci_method is not None:
+        check_resampling(ci_method, ci_resamples, ci_level, ci_chunk_mb)
+    check_datasheet(validate_datasheet(df, control_name))
+    df = preprocess(df)
+    if compact_dtypes:
+        df = compact_datasheet(df)
+    treatment_list, unit_rows = make_trmt_list(df, control_name)
+    df_final, pending_tests = run_treatments(df, treatment_list, unit_rows, control_name,
+                                             workers, batch_tests, None, cache_directory, None,
+                                             co_splicing_order, ci_method is not None, event_filter,
+                                             mwu_exact_max)
+    if cache_directory is not None:
+        evict_cache(cache_directory, cache_size_limit)
+    score_results(df_final, pending_tests, p_value_for_confidence, None, mwu_exact_max)
+    if ci_method is not None:
+        resample_ci(df_final, ci_method, ci_resamples, ci_level, ci_seed, ci_chunk_mb)
+    return finalize_results(df_final)
+
+# Axis labels of the plot
+plot_labels = {"magnitude": "Magnitude",
+               "diff_relative_abundance": "Difference in relative abundance of co-spliced isoform (treatment - control)",
+               "expt_unit": "Gene or experimental unit"}
+
+# Plot magnitude against diff_relative_abundance of df_final as HTML in 
+# directory/output_plots. Above webgl_threshold events the markers are drawn
+# with WebGL (scattergl) and only the plotted columns are embedded, rounded to
+# 6 decimals; above density_threshold events a 2-D histogram of bins x bins 
+# is plotted instead, so the HTML holds the bin counts and not every event.
+# include_plotlyjs is passed to write_html: "directory" lets all reports in
+# output_plots share one plotly.min.js instead of inlining it (about 3 MB) in
+# each report.
+def plot(df_final, plot_name, directory, webgl_threshold=5000, density_threshold=None, 
+         bins=200, include_plotlyjs=True):
+    import plotly.express as px
+    if density_threshold is not None and len(df_final) > density_threshold:
+        fig = density_plot(df_final, bins)
+    else:
+        if len(df_final) > webgl_threshold:
+            render_mode = 'webgl'
+            df_plot = df_final[["index", "expt_unit", "magnitude", "diff_relative_abundance", 
+                                "confidence_score"]].round(6)
+        else:
+            render_mode = 'auto'
+            df_plot = df_final
+        fig = px.scatter(df_plot, 
+                         x="magnitude", 
+                         y="diff_relative_abundance", 
+                         color="expt_unit", 
+                         size = "confidence_score",
+                         hover_data=['index'],
+                         title="Co-Splicing Index",
+                         labels=plot_labels,
+                         render_mode=render_mode,
+                         template='seaborn')
+        
+        fig.update_traces(marker=dict(line=dict(width=2,
+                                                color='DarkSlateGrey')),
+                          selector=dict(mode='markers'))
     
     # Create directory for plots
     try:
@@ -641,73 +1938,365 @@ def plot(df_final, plot_name, directory):
         pass
     
     # Write file to plots directory
-    fig.write_html(f"{directory}/output_plots/{plot_name}.html")
+    fig.write_html(f"{directory}/output_plots/{plot_name}.html", include_plotlyjs=include_plotlyjs)
+
+# Density view of the plot: number of events in each of bins x bins cells of
+# magnitude against diff_relative_abundance, binned here with numpy so only
+# the counts are embedded. Empty cells are left blank.
+def density_plot(df_final, bins):
+    import plotly.graph_objects as go
+    x = df_final["magnitude"].to_numpy(dtype=float)
+    y = df_final["diff_relative_abundance"].to_numpy(dtype=float)
+    finite = np.isfinite(x) & np.isfinite(y)
+    counts, x_edges, y_edges = np.histogram2d(x[finite], y[finite], bins=bins)
+    counts[counts == 0] = NaN
+    
+    fig = go.Figure(go.Heatmap(x=((x_edges[:-1] + x_edges[1:]) / 2).round(6),
+                               y=((y_edges[:-1] + y_edges[1:]) / 2).round(6),
+                               z=counts.T,
+                               colorscale='Viridis',
+                               colorbar=dict(title="Events"),
+                               hovertemplate="Magnitude: %{x}<br>Difference: %{y}<br>Events: %{z}<extra></extra>"))
+    fig.update_layout(title=f"Co-Splicing Index ({int(finite.sum())} events)",
+                      xaxis_title=plot_labels["magnitude"],
+                      yaxis_title=plot_labels["diff_relative_abundance"],
+                      template='seaborn')
+    return fig
+
+# Export df_final to output_datasheets in directory as CSV, Parquet or 
+# Feather (see datasheet_path)
+def export_datasheet(df_final, datasheet_name, directory):
+    # Create directory for datasheets
+    try:
+        mkdir(join(directory + "/output_datasheets"))
+    except FileExistsError:
+        pass
+    
+    write_datasheet(df_final, datasheet_path(directory, datasheet_name))
+
+## Incremental output
+# In incremental mode every experimental unit is scored, filtered and 
+# appended to the output datasheet (CSV) as soon as it is done, so results 
+# are not held in memory and an interrupted run only loses the unit in 
+# progress. A checkpoint manifest next to the datasheet records the units 
+# completed and the sizes of the files written for them; a rerun with the 
+# same input and parameters cuts the files back to the last checkpoint and 
+# resumes from the first unfinished unit. Adjusted p-values need the p-values
+# of all events, including the events filtered out (kept in a side file), so
+# they are filled in by a last pass over the datasheet (finish_incremental),
+# together with confidence scores if these use adjusted p-values. The 
+# manifest marks the start of this pass ("finishing"), after which the 
+# datasheet is no longer cut back: a rerun only redoes the last pass, which 
+# gives the same datasheet whether or not it had replaced the file. The plot
+# is drawn by a separate pass over the finished datasheet (plot_datasheet).
+
+# Paths of the output datasheet, its checkpoint manifest and the side file of
+# p-values of filtered events
+def incremental_paths(directory, datasheet_name):
+    path = datasheet_path(directory, datasheet_name)
+    if datasheet_format(path) != "csv":
+        raise ParameterError("Parameter Error: incremental_output writes the datasheet as CSV; use a .csv datasheet_name.")
+    stem = splitext(path)[0]
+    return path, stem + ".manifest.json", stem + ".dropped_p-values.bin"
+
+# Fingerprint of a run for its checkpoint: the input datasheet (size and 
+# modification time) and parameters, the list of parameters that change the
+# output
+def run_fingerprint(file_name, parameters):
+    info = stat(file_name)
+    text = json.dumps([file_name, info.st_size, info.st_mtime_ns, parameters], default=str)
+    return sha256(text.encode()).hexdigest()
+
+# Checkpoint manifest of a run that has not written anything yet
+def new_manifest(fingerprint):
+    return {"fingerprint": fingerprint, "units_completed": 0, "rows_written": 0,
+            "datasheet_bytes": 0, "dropped_bytes": 0, "finishing": False, "complete": False}
+
+# Checkpoint manifest of the run with fingerprint; a new manifest if there is
+# none or it belongs to another input or other parameters
+def load_manifest(manifest_path, fingerprint):
+    try:
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+    except (FileNotFoundError, ValueError):
+        manifest = {}
+    if manifest.get("fingerprint") != fingerprint:
+        manifest = new_manifest(fingerprint)
+    return manifest
+
+# Write the manifest atomically, so that it always describes complete units
+def save_manifest(manifest_path, manifest):
+    with NamedTemporaryFile("w", dir=dirname(manifest_path), suffix=".tmp", delete=False) as file:
+        json.dump(manifest, file, indent=1)
+    replace(file.name, manifest_path)
+
+# Cut file at path back to size bytes; False if it is missing or shorter
+def truncate_file(path, size):
+    try:
+        if getsize(path) < size:
+            return False
+    except FileNotFoundError:
+        return False
+    with open(path, "r+b") as file:
+        file.truncate(size)
+    return True
+
+# Score the results of one experimental unit ((ResultCollector, 
+# pending_tests) of its treatments) for incremental output: p-values of its
+# pending tests, resampling intervals (ci: arguments of resample_ci after 
+# df_final, or None) and confidence scores from raw p-values; adjusted 
+# p-values, and confidence scores from them, are left empty
+def score_unit(results, batch=True, order=2, ci=None, p_value_for_confidence="raw", counts=None,
+               exact_max=20):
+    df_unit, pending_tests = merge_results(results, batch, order, ci is not None)
+    fill_pending_tests(df_unit, pending_tests, counts, exact_max)
+    if ci is not None:
+        resample_ci(df_unit, *ci)
+    df_unit.insert(df_unit.columns.get_loc("p-value") + 1, "adjusted_p-value", NaN)
+    if p_value_for_confidence == "raw":
+        df_unit["confidence_score"] = [conf_calculator(a, b, p) for a, b, p in 
+                                       zip(df_unit["contributing_isoforms_count"],
+                                           df_unit["cospliced_isoforms"],
+                                           df_unit["p-value"])]
+    else:
+        df_unit["confidence_score"] = NaN
+    return df_unit
+
+# Run in incremental mode and return the number of rows of the output 
+# datasheet. units(start) gives the results of the experimental units from 
+# the start-th unit on (iter_unit_results, iter_streaming_units); 
+# fingerprint identifies the run (run_fingerprint). See score_unit for the 
+# other arguments.
+def run_incremental(units, directory, datasheet_name, fingerprint, batch=True, order=2, ci=None,
+                    p_value_for_confidence="raw", counts=None, exact_max=20):
+    if p_value_for_confidence not in ("raw", "adjusted"):
+        raise ParameterError("Parameter Error: p_value_for_confidence must be 'raw' or 'adjusted'.")
+    try:
+        mkdir(join(directory + "/output_datasheets"))
+    except FileExistsError:
+        pass
+    path, manifest_path, dropped_path = incremental_paths(directory, datasheet_name)
+    manifest = load_manifest(manifest_path, fingerprint)
+    if manifest["complete"]:
+        logger.info(f"Output datasheet {path} is already complete")
+        return manifest["rows_written"]
+    
+    # Resume after the last checkpoint, or start over
+    if manifest.get("finishing"):
+        logger.info("Resuming the last pass over the output datasheet")
+    elif manifest["units_completed"] > 0 and truncate_file(path, manifest["datasheet_bytes"]) \
+            and truncate_file(dropped_path, manifest["dropped_bytes"]):
+        logger.info(f"Resuming after {manifest['units_completed']} completed experimental units")
+    else:
+        manifest = new_manifest(fingerprint)
+        for stale in (path, dropped_path):
+            try:
+                remove(stale)
+            except FileNotFoundError:
+                pass
+        open(dropped_path, "wb").close()
+    
+    # Append the unfinished units (none left once the last pass has begun)
+    if not manifest.get("finishing"):
+        for key, trmts, results in units(manifest["units_completed"]):
+            df_unit = score_unit(results, batch, order, ci, p_value_for_confidence, counts, exact_max)
+            
+            # Filter out events with negative difference in relative abundance 
+            # (like finalize_results) and number the rows after those written
+            kept = (df_unit["diff_relative_abundance"] >= 0).to_numpy()
+            df_kept = df_unit[kept].reset_index(drop=True)
+            df_kept.insert(0, "index", np.arange(manifest["rows_written"], 
+                                                 manifest["rows_written"] + len(df_kept)))
+            with open(path, "a", newline="") as file:
+                df_kept.to_csv(file, header=manifest["datasheet_bytes"] == 0, index=False)
+            with open(dropped_path, "ab") as file:
+                file.write(df_unit.loc[~kept, "p-value"].to_numpy(dtype=np.float64).tobytes())
+            
+            manifest["units_completed"] += 1
+            manifest["rows_written"] += len(df_kept)
+            manifest["datasheet_bytes"] = getsize(path)
+            manifest["dropped_bytes"] = getsize(dropped_path)
+            save_manifest(manifest_path, manifest)
+    
+        manifest["finishing"] = True
+        save_manifest(manifest_path, manifest)
+    
+    finish_incremental(path, dropped_path, p_value_for_confidence)
+    manifest["complete"] = True
+    save_manifest(manifest_path, manifest)
+    remove(dropped_path)
+    return manifest["rows_written"]
+
+# Last pass of incremental output: fill in adjusted p-values over all events
+# (the rows of the datasheet and the filtered events of dropped_path), and 
+# confidence scores if they use adjusted p-values. The datasheet is 
+# rewritten chunk by chunk, keeping the text of all other columns.
+def finish_incremental(path, dropped_path, p_value_for_confidence="raw", chunksize=100000):
+    p = pd.read_csv(path, usecols=["p-value"], float_precision="round_trip")["p-value"]
+    dropped = np.fromfile(dropped_path, dtype=np.float64)
+    adjusted = benjamini_hochberg(np.concatenate([p.to_numpy(dtype=float), dropped]))[:len(p)]
+    
+    with NamedTemporaryFile("w", dir=dirname(path), suffix=".tmp", delete=False, newline="") as file:
+        start = 0
+        for chunk in pd.read_csv(path, dtype=str, keep_default_na=False, chunksize=chunksize):
+            chunk["adjusted_p-value"] = adjusted[start:start + len(chunk)]
+            if p_value_for_confidence == "adjusted":
+                chunk["confidence_score"] = [conf_calculator(int(a), int(b), q) for a, b, q in 
+                                             zip(chunk["contributing_isoforms_count"],
+                                                 chunk["cospliced_isoforms"],
+                                                 chunk["adjusted_p-value"])]
+            chunk.to_csv(file, header=start == 0, index=False)
+            start += len(chunk)
+        if start == 0:
+            with open(path) as datasheet:
+                file.write(datasheet.readline())
+    replace(file.name, path)
+
+# Plot a finished output datasheet at path (see plot for the arguments); 
+# only the plotted columns are read
+def plot_datasheet(path, plot_name, directory, webgl_threshold=5000, density_threshold=None, 
+                   bins=200, include_plotlyjs=True):
+    df_final = pd.read_csv(path, usecols=["index", "expt_unit", "magnitude", "diff_relative_abundance",
+                                          "confidence_score"],
+                           dtype={"expt_unit": str}, float_precision="round_trip")
+    plot(df_final, plot_name, directory, webgl_threshold, density_threshold, bins, include_plotlyjs)
 
 ##check; check if calculations here are correct!!!!
 
 # Execute
 if __name__ == '__main__':
-    # Read data and preprocess data
-    chdir(directory)
-    df = initiate(directory, file_name)
-    treatment_list = make_trmt_list(df)  
-    print("")
-    
-    # Create dictionary to change 0 to 1 and vice versa
-    swap_dict = {'1':'0', '0':'1'}
-    
-    # Create dictionary to access intermediate forms for magnitude calculations
-    interm_dict = { '10':( ('0','0'), ('1','1') ),
-                   '01': ( ('0','0'), ('1','1') ),
-                   '11': ( ('1','0'), ('0','1') ),
-                   '00': ( ('1','0'), ('0','1') )}
-    
-    # Create dataframe for storing output
-    df_final = pd.DataFrame(columns = ["expt_unit", 
-                                   "treatment", 
-                                   "cell_line",
-                                   "control_exon1", "control_exon2", 
-                                   "splicing_type", 
-                                   "contributing_isoforms_count",
-                                   "cospliced_isoforms",
-                                   "p-value",
-                                   "diff_relative_abundance",                                    
-                                   "confidence_score",
-                                   "magnitude"])
-    
-    # Start CSI calculation on dataframe
-    print("Initiating Co-Spliced Index (CSI) calculations")
-    for x, y, z in treatment_list:
-        print(f'Calculating for experiment unit "{x}", cell line "{y}" and treatment "{z}"')
-        process_diffRA(df, x, y, z, df_final)
-        print("Completed")
+    logging.basicConfig(level=log_level, format="%(message)s", stream=sys.stdout)
+    metrics = Metrics()
+    metrics.stages["import"] = perf_counter() - import_start
+    
+    try:
+        # Early pruning of events (None if no threshold is set)
+        event_filter = make_event_filter(min_diff_relative_abundance, min_magnitude, max_p_value, 
+                                         top_k_events, p_value_for_confidence)
+        check_co_splicing_order(co_splicing_order)
+        if ci_method is not None:
+            check_resampling(ci_method, ci_resamples, ci_level, ci_chunk_mb)
+    
+        # Read data and preprocess data
+        chdir(directory)
+        if incremental_output:
+            # Incremental mode writes every experimental unit to the output 
+            # datasheet as soon as it is done, with a checkpoint to resume from 
+            # (see run_incremental)
+            if stream_chunksize:
+                logger.info("Initiating Co-Spliced Index (CSI) calculations in streaming mode")
+                units = lambda start: iter_streaming_units(file_name, control_name, stream_chunksize,
+                                                           workers, batch_tests, spill_directory,
+                                                           cache_directory, metrics.counts,
+                                                           validation_report, co_splicing_order,
+                                                           ci_method is not None, compact_dtypes, start,
+                                                           event_filter, mwu_exact_max)
+            else:
+                df = initiate(directory, file_name, control_name, metrics, validation_report, 
+                              compact_dtypes)
+                with metrics.stage("work_list"):
+                    treatment_list, unit_rows = make_trmt_list(df, control_name)  
+                logger.info("")
+                logger.info("Initiating Co-Spliced Index (CSI) calculations")
+                units = lambda start: iter_unit_results(df, treatment_list, unit_rows, control_name,
+                                                        workers, batch_tests, None, cache_directory,
+                                                        metrics.counts, co_splicing_order,
+                                                        ci_method is not None, start, event_filter,
+                                                        mwu_exact_max)
+            ci = None if ci_method is None else (ci_method, ci_resamples, ci_level, ci_seed, ci_chunk_mb)
+            fingerprint = run_fingerprint(file_name, [control_name, co_splicing_order, 
+                                                      p_value_for_confidence, ci and ci[:4], 
+                                                      compact_dtypes, stream_chunksize,
+                                                      min_diff_relative_abundance, min_magnitude,
+                                                      max_p_value, top_k_events, mwu_exact_max])
+            with metrics.stage("csi_calculation"):
+                metrics.counts["rows_exported"] = run_incremental(units, directory, datasheet_name,
+                                                                  fingerprint, batch_tests,
+                                                                  co_splicing_order, ci,
+                                                                  p_value_for_confidence, 
+                                                                  metrics.counts, mwu_exact_max)
+            df = None
+        elif stream_chunksize:
+            # Streaming mode reads, preprocesses and calculates a few experimental
+            # units at a time
+            logger.info("Initiating Co-Spliced Index (CSI) calculations in streaming mode")
+            with metrics.stage("csi_calculation"):
+                df_final, pending_tests = run_streaming(file_name, control_name, stream_chunksize, 
+                                                        workers, batch_tests, spill_directory,
+                                                        cache_directory, metrics.counts,
+                                                        validation_report, co_splicing_order,
+                                                        ci_method is not None, compact_dtypes, 
+                                                        event_filter, mwu_exact_max)
+        else:
+            df = initiate(directory, file_name, control_name, metrics, validation_report, 
+                          compact_dtypes)
+            with metrics.stage("work_list"):
+                treatment_list, unit_rows = make_trmt_list(df, control_name)  
+            logger.info("")
         
-    # Filter out negative relative abundance values
-    df_final = df_final.query('diff_relative_abundance >= 0')
+            # Start CSI calculation on dataframe
+            logger.info("Initiating Co-Spliced Index (CSI) calculations")
+            with metrics.stage("csi_calculation"):
+                df_final, pending_tests = run_treatments(df, treatment_list, unit_rows, control_name,
+                                                         workers, batch_tests, None, cache_directory,
+                                                         metrics.counts, co_splicing_order,
+                                                         ci_method is not None, event_filter,
+                                                         mwu_exact_max)
+            df = None
     
-    # Reset index
-    df_final.reset_index(inplace=True, drop=True)
-    # Put index as first column of dataframe for plotting purposes
-    df_final.reset_index(level=0, inplace=True)
+        # Keep the result cache within its size cap
+        if cache_directory is not None:
+            evict_cache(cache_directory, cache_size_limit)
     
-    print("")
-    print("All CSI calculations completed.")
+        if not incremental_output:
+            # Run batched tests, adjust p-values for multiple testing and score events
+            with metrics.stage("tests"):
+                score_results(df_final, pending_tests, p_value_for_confidence, metrics.counts, 
+                              mwu_exact_max)
+        
+            # Resampling intervals of diff_relative_abundance
+            if ci_method is not None:
+                with metrics.stage("resampling"):
+                    resample_ci(df_final, ci_method, ci_resamples, ci_level, ci_seed, ci_chunk_mb)
+            
+            # Filter out negative relative abundance values and add index column
+            df_final = finalize_results(df_final)
+            metrics.counts["rows_exported"] = len(df_final)
     
-    # Plot
-    print("Generating plot")
-    plot(df_final, plot_name, directory)
+        logger.info("")
+        logger.info("All CSI calculations completed.")
     
-    ## Export datasheet as CSV
-    print("Exporting datasheet")
-    # Create directory for CSV
-    try:
-        mkdir(join(directory + "/output_datasheets"))
-    except FileExistsError:
-        pass
+        # Plot, unless in compute-only mode; in incremental mode from the 
+        # finished datasheet
+        if make_plot:
+            logger.info("Generating plot")
+            with metrics.stage("plotting"):
+                if incremental_output:
+                    plot_datasheet(datasheet_path(directory, datasheet_name), plot_name, directory,
+                                   plot_webgl_threshold, plot_density_threshold, plot_bins, 
+                                   plot_include_plotlyjs)
+                else:
+                    plot(df_final, plot_name, directory, plot_webgl_threshold, plot_density_threshold, 
+                         plot_bins, plot_include_plotlyjs)
+    
+        ## Export datasheet as CSV, Parquet or Feather (written already in 
+        #  incremental mode)
+        if not incremental_output:
+            logger.info("Exporting datasheet")
+            with metrics.stage("export"):
+                export_datasheet(df_final, datasheet_name, directory)
+        logger.info("All reports generated.")
     
-    df_final.to_csv(path_or_buf = f"{directory}/output_datasheets/{datasheet_name}.csv", index=False)
-    print("All reports generated.")
-    print("Programme complete.")    
+        # Stage timings and counters
+        for stage, seconds in metrics.stages.items():
+            logger.debug(f"{stage}: {seconds:.3f} s")
+        if metrics_file is not None:
+            metrics.save(metrics_file)
+            logger.info(f"Metrics written to {metrics_file}")
+        logger.info("Programme complete.")    
+    # Problems of the datasheet or parameters end the run with their message
+    except (DatasheetError, ParameterError) as error:
+        sys.exit(str(error))
     
     
     
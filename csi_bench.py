@@ -0,0 +1,232 @@
+# Synthetic datasheets and benchmarks for the Co-Splicing Index (CSI) pipeline
+
+# Generate a valid datasheet (seeded, so the same arguments always give the
+# same datasheet):
+#   python3 csi_bench.py generate synthetic.csv --units 100 --treatments 3
+# The format is chosen from the extension like in csi.py (.csv, .parquet,
+# .feather).
+
+# Time every stage of csi.py and measure its peak memory on a grid of
+# datasheet sizes, and save the results as JSON:
+#   python3 csi_bench.py run --grid small --output bench_small.json
+# Stages: read (read_datasheet), validate (validate_datasheet), preprocess 
+# (replicate merging), make_trmt_list, run_treatments (process_diffRA of all
+# treatments), score_results, finalize_results, plot and export. Peak memory
+# is the peak of memory allocated during the stage (tracemalloc, which slows
+# the stages down a little; --no-memory turns it off) and the peak resident
+# set size of the process at the end of each size.
+# Compare two result files stage by stage:
+#   python3 csi_bench.py compare bench_before.json bench_after.json
+
+# Modules
+import sys
+import json
+import argparse
+import platform
+import tracemalloc
+from time import perf_counter
+from time import strftime
+from os import devnull
+from os.path import join
+from tempfile import TemporaryDirectory
+from contextlib import redirect_stdout
+import numpy as np
+import pandas as pd
+import csi
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Size grids; each size is passed to generate_datasheet
+grids = {"small":  [dict(units=10,   cell_lines=1, treatments=2, isoforms=4, exons=4, replicates=3),
+                    dict(units=50,   cell_lines=1, treatments=2, isoforms=4, exons=4, replicates=3),
+                    dict(units=100,  cell_lines=2, treatments=3, isoforms=5, exons=5, replicates=3)],
+         "medium": [dict(units=200,  cell_lines=2, treatments=3, isoforms=6, exons=6, replicates=3),
+                    dict(units=500,  cell_lines=2, treatments=4, isoforms=6, exons=6, replicates=3),
+                    dict(units=1000, cell_lines=2, treatments=4, isoforms=8, exons=8, replicates=4)],
+         "large":  [dict(units=2000, cell_lines=2, treatments=5, isoforms=8, exons=8, replicates=4),
+                    dict(units=5000, cell_lines=3, treatments=5, isoforms=8, exons=10, replicates=4)]}
+
+control_name = "NC"
+
+## Generator
+# Make a datasheet with units experimental units, each with cell_lines cell
+# lines, a control and treatments treatments, isoforms isoforms with distinct
+# exon patterns over exons exons and replicates biological replicates.
+# Relative abundance sums to 1 in every replicate, and about zero_fraction of
+# the isoforms are absent (0) in each replicate. Exon columns run up to
+# max_exons (default exons) and are NA beyond the exons of the unit; when
+# vary_exons is True each unit has between 2 and exons exons.
+def generate_datasheet(units=10, cell_lines=1, treatments=2, isoforms=4, exons=4, replicates=3,
+                       seed=0, max_exons=None, vary_exons=False, zero_fraction=0.1):
+    rng = np.random.default_rng(seed)
+    max_exons = exons if max_exons is None else max_exons
+    conditions = [control_name] + [f"T{i + 1}" for i in range(treatments)]
+    isoform_names = np.array([chr(65 + i % 26) + (str(i // 26) if i >= 26 else "")
+                              for i in range(isoforms)])
+
+    frames = []
+    for unit in range(units):
+        n_exons = int(rng.integers(2, exons + 1)) if vary_exons else exons
+        n_isoforms = min(isoforms, 2**n_exons)
+
+        # Distinct exon patterns of the isoforms, as rows of 0 and 1
+        codes = rng.choice(2**n_exons, size=n_isoforms, replace=False) if n_exons < 31 \
+            else np.unique(rng.integers(0, 2**n_exons, size=n_isoforms))
+        flags = ((codes[:, None] >> np.arange(n_exons)) & 1).astype(float)
+        flags = np.hstack([flags, np.full((len(codes), max_exons - n_exons), np.nan)])
+
+        # One block of isoforms per cell line, condition and replicate
+        blocks = [(f"cell{c + 1}", condition, replicate + 1) for c in range(cell_lines)
+                  for condition in conditions for replicate in range(replicates)]
+        ra = rng.random((len(blocks), len(codes)))
+        ra[rng.random(ra.shape) < zero_fraction] = 0
+        ra[ra.sum(axis=1) == 0, 0] = 1
+        ra = (ra / ra.sum(axis=1, keepdims=True)).round(4)
+
+        frame = pd.DataFrame(np.tile(flags, (len(blocks), 1)),
+                             columns=[f"E{i + 1}" for i in range(max_exons)])
+        frame.insert(0, "expt_unit", f"gene{unit + 1}")
+        frame.insert(1, "cell_line", np.repeat([block[0] for block in blocks], len(codes)))
+        frame.insert(2, "treatment", np.repeat([block[1] for block in blocks], len(codes)))
+        frame.insert(3, "isoform", np.tile(isoform_names[:len(codes)], len(blocks)))
+        frame.insert(4, "exons", ",".join(str(10 + i) for i in range(n_exons)))
+        frame["replicate_ID"] = np.repeat([block[2] for block in blocks], len(codes))
+        frame["relative_abundance"] = ra.ravel()
+        frames += [frame]
+
+    df = pd.concat(frames, ignore_index=True)
+    # Shuffle rows, as datasheets merged from several runs are not ordered
+    return df.iloc[rng.permutation(len(df))].reset_index(drop=True)
+
+## Benchmark
+# Run fn(*args) as one stage: record its wall time and, if measure_memory,
+# the peak of memory allocated during it (MB) in stages[name]. Output
+# printed by csi.py is discarded. Returns the result of fn.
+def time_stage(stages, name, measure_memory, fn, *args):
+    if measure_memory:
+        tracemalloc.start()
+    with open(devnull, "w") as null, redirect_stdout(null):
+        start = perf_counter()
+        result = fn(*args)
+        seconds = perf_counter() - start
+    stages[name] = {"seconds": seconds}
+    if measure_memory:
+        stages[name]["peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+    return result
+
+# Peak resident set size of this process so far (MB), or None if unknown
+def max_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss / 1024**2 if sys.platform == "darwin" else rss / 1024
+
+# Validate df like csi.initiate
+def validate_stage(df):
+    csi.check_datasheet(csi.validate_datasheet(df, control_name))
+
+# Run all stages of the pipeline once on the datasheet at path, writing the
+# plot and datasheet to directory. Returns (stages, number of events).
+def run_pipeline(path, directory, workers, measure_memory):
+    stages = {}
+    df = time_stage(stages, "read", measure_memory, csi.read_datasheet, path)
+    time_stage(stages, "validate", measure_memory, validate_stage, df)
+    df = time_stage(stages, "preprocess", measure_memory, csi.preprocess, df)
+    treatment_list, unit_rows = time_stage(stages, "make_trmt_list", measure_memory,
+                                           csi.make_trmt_list, df, control_name)
+    df_final, pending_tests = time_stage(stages, "run_treatments", measure_memory,
+                                         csi.run_treatments, df, treatment_list, unit_rows,
+                                         control_name, workers)
+    time_stage(stages, "score_results", measure_memory,
+               csi.score_results, df_final, pending_tests)
+    df_final = time_stage(stages, "finalize_results", measure_memory,
+                          csi.finalize_results, df_final)
+    time_stage(stages, "plot", measure_memory, csi.plot, df_final, "bench", directory)
+    time_stage(stages, "export", measure_memory,
+               csi.export_datasheet, df_final, "bench", directory)
+    stages["total"] = {"seconds": sum(stage["seconds"] for stage in stages.values())}
+    return stages, len(df_final)
+
+# Benchmark every size of grid; each size is run repeat times and the run
+# with the lowest total time is kept. Returns the results as a dictionary.
+def benchmark(grid, seed=0, repeat=1, workers=1, file_format=".csv", measure_memory=True):
+    results = []
+    for size in grid:
+        with TemporaryDirectory() as directory:
+            path = join(directory, "synthetic" + file_format)
+            df = generate_datasheet(seed=seed, **size)
+            csi.write_datasheet(df, path)
+            runs = [run_pipeline(path, directory, workers, measure_memory) for i in range(repeat)]
+            stages, n_events = min(runs, key=lambda run: run[0]["total"]["seconds"])
+        results += [{"size": size, "rows": len(df), "events": n_events,
+                     "stages": stages, "max_rss_mb": max_rss_mb()}]
+        print(f"{len(df)} rows, {n_events} events: {stages['total']['seconds']:.2f} s")
+
+    return {"timestamp": strftime("%Y-%m-%dT%H:%M:%S"),
+            "seed": seed, "repeat": repeat, "workers": workers, "format": file_format,
+            "python": platform.python_version(), "platform": platform.platform(),
+            "versions": {module.__name__: module.__version__ for module in (np, pd)},
+            "results": results}
+
+# Print the time of every stage of two benchmark result files side by side,
+# for the sizes present in both
+def compare(before, after):
+    after_of = {json.dumps(result["size"], sort_keys=True): result for result in after["results"]}
+    for result in before["results"]:
+        other = after_of.get(json.dumps(result["size"], sort_keys=True))
+        if other is None:
+            continue
+        print(f"{result['rows']} rows")
+        for stage, timing in result["stages"].items():
+            if stage in other["stages"]:
+                new = other["stages"][stage]["seconds"]
+                ratio = timing["seconds"] / new if new > 0 else float("inf")
+                print(f"  {stage:18} {timing['seconds']:10.3f} s {new:10.3f} s  x{ratio:.2f}")
+
+# Execute
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Synthetic datasheets and benchmarks for csi.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="write a synthetic datasheet")
+    generate.add_argument("path")
+    for name, default in (("units", 10), ("cell_lines", 1), ("treatments", 2), ("isoforms", 4),
+                          ("exons", 4), ("replicates", 3), ("seed", 0)):
+        generate.add_argument("--" + name.replace("_", "-"), type=int, default=default)
+    generate.add_argument("--max-exons", type=int, default=None)
+    generate.add_argument("--vary-exons", action="store_true")
+
+    run = commands.add_parser("run", help="benchmark csi.py on a grid of sizes")
+    run.add_argument("--grid", choices=sorted(grids), default="small")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--repeat", type=int, default=1)
+    run.add_argument("--workers", type=int, default=1)
+    run.add_argument("--format", choices=sorted(csi.datasheet_formats), default=".csv")
+    run.add_argument("--no-memory", action="store_true")
+    run.add_argument("--output", default="bench_results.json")
+
+    comparison = commands.add_parser("compare", help="compare two benchmark result files")
+    comparison.add_argument("before")
+    comparison.add_argument("after")
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        df = generate_datasheet(args.units, args.cell_lines, args.treatments, args.isoforms,
+                                args.exons, args.replicates, args.seed, args.max_exons,
+                                args.vary_exons)
+        csi.write_datasheet(df, args.path)
+        print(f"Wrote {len(df)} rows to {args.path} (control: {control_name})")
+    elif args.command == "run":
+        results = benchmark(grids[args.grid], args.seed, args.repeat, args.workers,
+                            args.format, not args.no_memory)
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Results saved to {args.output}")
+    else:
+        with open(args.before) as before, open(args.after) as after:
+            compare(json.load(before), json.load(after))
@@ -0,0 +1,332 @@
+# Local job server for Co-Splicing Index (CSI) calculations
+
+# A long-running service on localhost that calculates CSI for datasheets
+# submitted over HTTP, so that many small datasheets do not each pay for a
+# cold start of csi.py (importing pandas, scipy and plotly, reading
+# user_inputs.py). Jobs are queued onto a pool of worker processes that are
+# started once, with their imports loaded, and that share the result cache
+# (cache_directory) across jobs:
+#   python3 csi_server.py --port 8765 --workers 2
+# Submit a datasheet (CSV by default; format=parquet or feather for columnar
+# files) with its parameters in the query string, which returns the job id:
+#   curl --data-binary @test_input.csv "http://127.0.0.1:8765/jobs?control_name=NC2"
+# Then poll the job and fetch its results:
+#   GET /jobs/{id}              status: queued, running, done or failed
+#   GET /jobs/{id}/datasheet    output datasheet (CSV)
+#   GET /jobs/{id}/plot         HTML plot
+#   GET /jobs/{id}/log          progress and validation messages of the job
+#   GET /jobs                   status of all jobs
+#   GET /status                 queue, completed jobs and throughput
+# Parameters not given with a job are read from user_inputs.py like csi.py;
+# job_parameters lists those that can be given per job. Files of every job
+# are kept in the jobs directory (--jobs-directory) until the number of
+# finished jobs exceeds --keep-jobs; their names are fixed (job_files), 
+# nothing in a request names a file.
+
+# Modules
+import sys
+import json
+import asyncio
+import logging
+import argparse
+from time import time
+from time import perf_counter
+from uuid import uuid4
+from shutil import rmtree
+from os import makedirs
+from os.path import join
+from os.path import exists
+from urllib.parse import urlsplit
+from urllib.parse import parse_qsl
+from concurrent.futures import ProcessPoolExecutor
+import csi
+from csi import logger
+
+# Value of a job parameter given as text; "none" is None
+def optional(convert):
+    return lambda text: None if text.lower() == "none" else convert(text)
+
+# Parameters that can be given per job in the query string, with the
+# conversion of their text; all others are read from user_inputs.py
+job_parameters = {"control_name": str,
+                  "make_plot": lambda text: text.lower() in ("1", "true", "yes"),
+                  "p_value_for_confidence": str,
+                  "co_splicing_order": int,
+                  "min_diff_relative_abundance": optional(float),
+                  "min_magnitude": optional(float),
+                  "max_p_value": optional(float),
+                  "top_k_events": optional(int),
+                  "ci_method": optional(str),
+                  "ci_resamples": int,
+                  "ci_level": float,
+                  "ci_seed": int,
+                  "mwu_exact_max": optional(int)}
+
+# Results of a job by name: (path in the job directory, content type)
+job_files = {"datasheet": (join("output_datasheets", "csi.csv"), "text/csv"),
+             "plot": (join("output_plots", "csi.html"), "text/html"),
+             "log": ("log.txt", "text/plain")}
+
+# Status codes of the responses
+reasons = {200: "OK", 202: "Accepted", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+           405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large",
+           503: "Service Unavailable"}
+
+## Worker processes
+# Load the modules of a calculation once per worker process, so that jobs
+# start warm
+def warm_worker(log_level):
+    logging.basicConfig(level=log_level, format="%(message)s", stream=sys.stdout)
+    import scipy.stats
+    import plotly.express
+
+# Calculate one job in a worker process: read the datasheet input_name in
+# job_directory, compute CSI (csi.compute_csi) with parameters (job
+# parameters over user_inputs.py), then plot and export like csi.py into
+# job_directory/output_plots and output_datasheets. Messages of the job are
+# written to job_directory/log.txt. Returns (rows, seconds, error), error
+# being None if the job succeeded.
+def run_job(job_directory, input_name, parameters):
+    start = perf_counter()
+    handler = logging.FileHandler(join(job_directory, "log.txt"))
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    try:
+        df = csi.read_datasheet(join(job_directory, input_name))
+        df_final = csi.compute_csi(df, parameters["control_name"], 1, csi.batch_tests,
+                                   parameters["p_value_for_confidence"], csi.cache_directory,
+                                   csi.cache_size_limit, parameters["co_splicing_order"],
+                                   parameters["ci_method"], parameters["ci_resamples"],
+                                   parameters["ci_level"], parameters["ci_seed"], csi.ci_chunk_mb,
+                                   csi.compact_dtypes, parameters["min_diff_relative_abundance"],
+                                   parameters["min_magnitude"], parameters["max_p_value"],
+                                   parameters["top_k_events"], parameters["mwu_exact_max"])
+        if parameters["make_plot"]:
+            csi.plot(df_final, "csi", job_directory, csi.plot_webgl_threshold,
+                     csi.plot_density_threshold, csi.plot_bins, csi.plot_include_plotlyjs)
+        csi.export_datasheet(df_final, "csi.csv", job_directory)
+        return len(df_final), perf_counter() - start, None
+    # Problems of the datasheet or parameters fail the job with their message
+    except (csi.DatasheetError, csi.ParameterError) as error:
+        logger.error(str(error))
+        return None, perf_counter() - start, str(error)
+    except Exception as error:
+        logger.exception("Job failed")
+        return None, perf_counter() - start, f"{type(error).__name__}: {error}"
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+## Server
+# Jobs (by id, in order of submission) and their worker pool. At most
+# workers jobs run at a time; at most max_queued jobs wait for a worker,
+# further submissions are refused (503) until the queue shortens.
+class JobServer:
+    def __init__(self, jobs_directory, workers=1, max_queued=100, keep_jobs=1000,
+                 max_upload_mb=512):
+        self.jobs_directory = jobs_directory
+        self.workers = workers
+        self.max_queued = max_queued
+        self.keep_jobs = keep_jobs
+        self.max_upload_mb = max_upload_mb
+        self.jobs = {}
+        self.started = time()
+        self.running = asyncio.Semaphore(workers)
+        self.pool = ProcessPoolExecutor(workers, initializer=warm_worker, initargs=(csi.log_level,))
+
+    # Number of jobs with status
+    def count(self, status):
+        return sum(job["status"] == status for job in self.jobs.values())
+
+    # Public status of a job
+    def job_status(self, job_id):
+        job = self.jobs[job_id]
+        return {key: value for key, value in job.items() if key not in ("directory", "input_name")}
+
+    # Queue and throughput of the server. Jobs per minute are the jobs
+    # finished over the uptime; wait is the time from submission to start.
+    def server_status(self):
+        finished = [job for job in self.jobs.values() if job["status"] in ("done", "failed")]
+        uptime = time() - self.started
+        mean = lambda values: sum(values) / len(values) if values else None
+        return {"workers": self.workers,
+                "queued": self.count("queued"),
+                "running": self.count("running"),
+                "done": self.count("done"),
+                "failed": self.count("failed"),
+                "uptime_seconds": round(uptime, 3),
+                "jobs_per_minute": round(len(finished) / uptime * 60, 3),
+                "mean_wait_seconds": mean([job["started"] - job["submitted"] for job in finished]),
+                "mean_run_seconds": mean([job["seconds"] for job in finished])}
+
+    # Create a job for a datasheet (bytes body of format fmt) with the job
+    # parameters of query; returns the job id
+    def submit(self, body, fmt, query):
+        parameters = {name: getattr(csi, name) for name in job_parameters}
+        for name, text in query.items():
+            if name not in job_parameters:
+                raise ValueError(f"unknown job parameter '{name}'")
+            try:
+                parameters[name] = job_parameters[name](text)
+            except ValueError:
+                raise ValueError(f"invalid value of job parameter '{name}': '{text}'")
+        if parameters["control_name"] is None:
+            raise ValueError("control_name is required")
+
+        job_id = uuid4().hex
+        directory = join(self.jobs_directory, job_id)
+        input_name = "input" + {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}[fmt]
+        makedirs(directory)
+        with open(join(directory, input_name), "wb") as file:
+            file.write(body)
+        self.jobs[job_id] = {"id": job_id, "status": "queued", "parameters": parameters,
+                             "submitted": time(), "started": None, "finished": None,
+                             "seconds": None, "rows": None, "error": None,
+                             "directory": directory, "input_name": input_name}
+        asyncio.get_running_loop().create_task(self.run(job_id))
+        return job_id
+
+    # Wait for a free worker, run the job in the pool and record its result
+    async def run(self, job_id):
+        job = self.jobs[job_id]
+        async with self.running:
+            job["status"] = "running"
+            job["started"] = time()
+            try:
+                rows, seconds, error = await asyncio.get_running_loop().run_in_executor(
+                    self.pool, run_job, job["directory"], job["input_name"], job["parameters"])
+            except Exception as exception:
+                rows, seconds, error = None, time() - job["started"], f"{type(exception).__name__}: {exception}"
+        job.update(status="failed" if error else "done", finished=time(), seconds=seconds,
+                   rows=rows, error=error)
+        logger.info(f"Job {job_id} {job['status']} in {seconds:.3f} s")
+        self.forget_old_jobs()
+
+    # Remove the oldest finished jobs and their files beyond keep_jobs
+    def forget_old_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job["status"] in ("done", "failed")]
+        for job_id in finished[:max(0, len(finished) - self.keep_jobs)]:
+            rmtree(self.jobs.pop(job_id)["directory"], ignore_errors=True)
+
+    # Response (status, content type, body bytes) to one request
+    def respond(self, method, target, body, too_large=False):
+        url = urlsplit(target)
+        path = [x for x in url.path.split("/") if x]
+
+        if path == ["jobs"] and method == "POST":
+            if too_large:
+                return error_response(413, f"datasheets are limited to {self.max_upload_mb} MB")
+            if self.count("queued") >= self.max_queued:
+                return error_response(503, "job queue is full, try again later")
+            query = dict(parse_qsl(url.query))
+            fmt = query.pop("format", "csv")
+            if fmt not in ("csv", "parquet", "feather"):
+                return error_response(400, "format must be csv, parquet or feather")
+            if len(body) == 0:
+                return error_response(400, "the request body must be a datasheet")
+            try:
+                job_id = self.submit(body, fmt, query)
+            except ValueError as error:
+                return error_response(400, str(error))
+            return json_response(202, self.job_status(job_id))
+
+        if method != "GET":
+            return error_response(405, f"{method} is not supported here")
+        if path == ["status"]:
+            return json_response(200, self.server_status())
+        if path == ["jobs"]:
+            return json_response(200, [self.job_status(job_id) for job_id in self.jobs])
+        if len(path) < 2 or path[0] != "jobs" or path[1] not in self.jobs:
+            return error_response(404, "no such job")
+
+        job = self.jobs[path[1]]
+        if len(path) == 2:
+            return json_response(200, self.job_status(path[1]))
+        if len(path) != 3 or path[2] not in job_files:
+            return error_response(404, "no such result")
+        name, content_type = job_files[path[2]]
+        if path[2] != "log" and job["status"] != "done":
+            return error_response(409, f"job is {job['status']}")
+        if not exists(join(job["directory"], name)):
+            return error_response(404, f"job has no {path[2]}")
+        with open(join(job["directory"], name), "rb") as file:
+            return 200, content_type + "; charset=utf-8", file.read()
+
+    # Serve one HTTP/1.1 connection: a single request, then the connection is
+    # closed. Requests sent by web pages (with an Origin header) are refused,
+    # so that a page open in a browser on this machine cannot submit jobs.
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1")
+                if line in ("\r\n", "\n", ""):
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if len(request_line) != 3:
+                status, content_type, body = error_response(400, "malformed request")
+            elif "origin" in headers:
+                status, content_type, body = error_response(403, "requests from web pages are not accepted")
+            else:
+                length = int(headers.get("content-length", 0))
+                too_large = length > self.max_upload_mb * 1024**2
+                request_body = b"" if too_large else await reader.readexactly(length)
+                status, content_type, body = self.respond(request_line[0], request_line[1],
+                                                          request_body, too_large)
+        except (ValueError, asyncio.IncompleteReadError):
+            status, content_type, body = error_response(400, "malformed request")
+        writer.write(f"HTTP/1.1 {status} {reasons[status]}\r\n"
+                     f"Content-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\n"
+                     "Connection: close\r\n\r\n".encode("latin-1") + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+# JSON response (status, content type, body bytes)
+def json_response(status, content):
+    return status, "application/json", json.dumps(content, indent=1).encode()
+
+# JSON response of an error with message
+def error_response(status, message):
+    return json_response(status, {"error": message})
+
+# Run the job server on host:port until it is interrupted
+async def serve(host, port, jobs_directory, workers=1, max_queued=100, keep_jobs=1000,
+                max_upload_mb=512):
+    makedirs(jobs_directory, exist_ok=True)
+    server = JobServer(jobs_directory, workers, max_queued, keep_jobs, max_upload_mb)
+    try:
+        listener = await asyncio.start_server(server.handle, host, port)
+        logger.info(f"Serving CSI jobs on http://{host}:{port} with {workers} worker(s)")
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.pool.shutdown(cancel_futures=True)
+
+# Execute
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local job server for csi.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=csi.workers,
+                        help="jobs calculated at the same time")
+    parser.add_argument("--max-queued", type=int, default=100,
+                        help="jobs waiting for a worker before submissions are refused")
+    parser.add_argument("--keep-jobs", type=int, default=1000,
+                        help="finished jobs whose results are kept")
+    parser.add_argument("--max-upload-mb", type=int, default=512)
+    parser.add_argument("--jobs-directory", default=None,
+                        help="directory of the files of every job (default: directory/output_jobs)")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=csi.log_level, format="%(message)s", stream=sys.stdout)
+    jobs_directory = args.jobs_directory or join(csi.directory or ".", "output_jobs")
+    try:
+        asyncio.run(serve(args.host, args.port, jobs_directory, args.workers, args.max_queued,
+                          args.keep_jobs, args.max_upload_mb))
+    except KeyboardInterrupt:
+        pass
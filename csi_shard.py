@@ -0,0 +1,199 @@
+# Sharded Co-Splicing Index (CSI) runs for cluster schedulers
+
+# Split a run of csi.py into many small jobs. Every job calculates one shard
+# of the experimental units and writes a partial result file; a merge job
+# then combines the partial results into the same output datasheet and plot
+# as a single run of csi.py:
+#   python3 csi_shard.py run 0 16      (shard 0 of 16, shards are 0 ... 15)
+#   python3 csi_shard.py run 1 16
+#   ...
+#   python3 csi_shard.py merge 16
+# Parameters are read from user_inputs.py like csi.py. Rows are assigned to a
+# shard by a stable hash (crc32) of expt_unit and cell_line, so every shard
+# holds whole experimental units and a control stays with all of its
+# treatments. Each job reads the datasheet in chunks and keeps only the rows
+# of its shard.
+# Partial results are written to directory/output_shards. They hold the rows
+# of df_final with raw p-values (and resampling intervals, see ci_method); the
+# merge puts the rows in the order of a single run, then adjusts p-values over
+# all events, scores, finalizes, plots and exports like csi.py.
+
+# Modules
+import sys
+import logging
+import argparse
+import pickle
+from os import chdir
+from os import mkdir
+from os import replace
+from os.path import join
+from os.path import splitext
+from os.path import exists
+from tempfile import NamedTemporaryFile
+from zlib import crc32
+import numpy as np
+import pandas as pd
+import csi
+from csi import logger
+
+# Rows per chunk when reading the datasheet (stream_chunksize if set)
+read_chunksize = 100000
+
+## Sharding
+# Shard (0 ... shards - 1) of every row of df, from expt_unit and cell_line
+def shard_of(df, shards):
+    return np.array([crc32(f"{EU}\0{cell_type}".encode()) % shards
+                     for EU, cell_type in zip(df["expt_unit"], df["cell_line"])], dtype=np.int64)
+
+# Rows of the datasheet at path in shard shard of shards, read in chunks of
+# chunksize rows. The index is the row number in the datasheet, so that
+# validation reports and treatment order refer to the whole datasheet.
+def read_shard(path, shard, shards, chunksize):
+    parts = []
+    offset = 0
+    for chunk in csi.iter_datasheet_chunks(path, chunksize):
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+        offset += len(chunk)
+        parts += [chunk[shard_of(chunk, shards) == shard]]
+    return pd.concat(parts)
+
+# First appearance of every value of expt_unit, cell_line and treatment in
+# the preprocessed datasheet df, as (merged, row): preprocess puts rows 
+# without replicates first, in datasheet order, then merged replicates in 
+# order of first appearance, and rows keep their datasheet row number as 
+# index. make_trmt_list orders treatments by the first appearance of their 
+# expt_unit, then of their cell_line, then of their treatment name in the 
+# whole datasheet; the merge takes the first appearance over all shards.
+def first_appearances(df):
+    merged = np.array([type(x) == list for x in df["replicates"]], dtype=np.int64)
+    row = df.index.to_numpy()
+    appearances = {}
+    for col in ("expt_unit", "cell_line", "treatment"):
+        first = ~df[col].duplicated().to_numpy()
+        appearances[col] = dict(zip(df[col][first], zip(merged[first].tolist(), row[first].tolist())))
+    return appearances
+
+# Path of a per-shard file: directory/output_shards/{name}.{shard}-of-{shards}{extension}
+def shard_path(directory, name, shard, shards, extension=".pkl"):
+    return join(directory, "output_shards", f"{splitext(name)[0]}.{shard}-of-{shards}{extension}")
+
+## Shard job
+# Calculate shard shard of shards with the parameters of user_inputs.py and
+# write its partial result: df_final before scoring and the first 
+# appearances of its experimental units, cell lines and treatments 
+# (first_appearances)
+def run_shard(shard, shards):
+    if not 0 <= shard < shards:
+        raise csi.ParameterError(f"Shard Error: shard must be between 0 and {shards - 1}.")
+    csi.check_co_splicing_order(csi.co_splicing_order)
+    if csi.ci_method is not None:
+        csi.check_resampling(csi.ci_method, csi.ci_resamples, csi.ci_level, csi.ci_chunk_mb)
+    chdir(csi.directory)
+    try:
+        mkdir(join(csi.directory, "output_shards"))
+    except FileExistsError:
+        pass
+
+    logger.info(f"Reading shard {shard} of {shards}")
+    df = read_shard(csi.file_name, shard, shards, csi.stream_chunksize or read_chunksize)
+    logger.info("Validating datasheet")
+    report_path = None
+    if csi.validation_report is not None:
+        report_path = shard_path(csi.directory, csi.validation_report, shard, shards, ".json")
+    csi.check_datasheet(csi.validate_datasheet(df, csi.control_name), report_path)
+    df = csi.preprocess(df)
+    appearances = first_appearances(df)
+    if csi.compact_dtypes:
+        df = csi.compact_datasheet(df)
+    treatment_list, unit_rows = csi.make_trmt_list(df, csi.control_name)
+    event_filter = csi.make_event_filter(csi.min_diff_relative_abundance, csi.min_magnitude,
+                                         csi.max_p_value, csi.top_k_events, 
+                                         csi.p_value_for_confidence)
+
+    logger.info("Initiating Co-Spliced Index (CSI) calculations")
+    df_final, pending_tests = csi.run_treatments(df, treatment_list, unit_rows, csi.control_name,
+                                                 csi.workers, csi.batch_tests, None,
+                                                 csi.cache_directory, None, csi.co_splicing_order,
+                                                 csi.ci_method is not None, event_filter,
+                                                 csi.mwu_exact_max)
+    df = None
+    if csi.cache_directory is not None:
+        csi.evict_cache(csi.cache_directory, csi.cache_size_limit)
+    csi.fill_pending_tests(df_final, pending_tests, None, csi.mwu_exact_max)
+    if csi.ci_method is not None:
+        csi.resample_ci(df_final, csi.ci_method, csi.ci_resamples, csi.ci_level, csi.ci_seed,
+                        csi.ci_chunk_mb)
+
+    # Written to a temporary file first, so that the merge never reads a
+    # partial result that is still being written
+    path = shard_path(csi.directory, csi.datasheet_name, shard, shards)
+    with NamedTemporaryFile(dir=join(csi.directory, "output_shards"), suffix=".tmp",
+                            delete=False) as file:
+        pickle.dump((df_final, appearances), file, protocol=pickle.HIGHEST_PROTOCOL)
+    replace(file.name, path)
+    logger.info(f"Partial result of {len(df_final)} rows written to {path}")
+
+## Merge job
+# Combine the partial results of all shards into df_final in the row order
+# of a single run: by the first appearance in the whole datasheet of the 
+# expt_unit, cell_line and treatment of each row, then by row within the 
+# treatment (rows of one treatment all come from one shard)
+def merge_partials(directory, datasheet_name, shards):
+    frames = []
+    first = {"expt_unit": {}, "cell_line": {}, "treatment": {}}
+    for shard in range(shards):
+        path = shard_path(directory, datasheet_name, shard, shards)
+        if not exists(path):
+            raise FileNotFoundError(f"Shard Error: partial result of shard {shard} of {shards} not found ({path}).")
+        with open(path, "rb") as file:
+            df_part, appearances = pickle.load(file)
+        frames += [df_part]
+        for col, values in appearances.items():
+            for value, position in values.items():
+                first[col][value] = min(position, first[col].get(value, position))
+    
+    df_final = pd.concat(frames, ignore_index=True)
+    ranks = [df_final[col].map({value: rank for rank, value in enumerate(sorted(values, key=values.get))})
+             for col, values in first.items()]
+    rows = np.lexsort([np.arange(len(df_final))] + [rank.to_numpy() for rank in ranks[::-1]])
+    return df_final.iloc[rows].reset_index(drop=True)
+
+# Merge the partial results of shards shards with the parameters of
+# user_inputs.py, then score, plot and export like csi.py
+def merge_shards(shards):
+    chdir(csi.directory)
+    logger.info(f"Merging partial results of {shards} shards")
+    df_final = merge_partials(csi.directory, csi.datasheet_name, shards)
+    csi.score_results(df_final, None, csi.p_value_for_confidence)
+    df_final = csi.finalize_results(df_final)
+    logger.info("All CSI calculations completed.")
+
+    if csi.make_plot:
+        logger.info("Generating plot")
+        csi.plot(df_final, csi.plot_name, csi.directory, csi.plot_webgl_threshold,
+                 csi.plot_density_threshold, csi.plot_bins, csi.plot_include_plotlyjs)
+    logger.info("Exporting datasheet")
+    csi.export_datasheet(df_final, csi.datasheet_name, csi.directory)
+    logger.info("All reports generated.")
+
+# Execute
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sharded runs of csi.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="calculate one shard and write its partial result")
+    run.add_argument("shard", type=int, help="shard to calculate (0 ... shards - 1)")
+    run.add_argument("shards", type=int, help="number of shards")
+
+    merge = commands.add_parser("merge", help="merge the partial results of all shards")
+    merge.add_argument("shards", type=int, help="number of shards")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=csi.log_level, format="%(message)s", stream=sys.stdout)
+    try:
+        if args.command == "run":
+            run_shard(args.shard, args.shards)
+        else:
+            merge_shards(args.shards)
+    except (csi.DatasheetError, csi.ParameterError, FileNotFoundError) as error:
+        sys.exit(str(error))
@@ -0,0 +1,27 @@
+# Shared fixtures of the tests of csi.py and its companion scripts
+
+# Modules
+import sys
+from os.path import dirname
+from os.path import join
+import pytest
+import pandas as pd
+
+sys.path.insert(0, dirname(dirname(__file__)))
+import csi_bench
+
+# Sample datasheet shipped with the repository
+sample_path = join(dirname(dirname(__file__)), "sample_input_output", "test_input.csv")
+
+@pytest.fixture
+def sample():
+    return pd.read_csv(sample_path)
+
+# Synthetic datasheet (control "NC") whose unit gene1 has a single control 
+# replicate, so its treatment events have replicates but the control has 
+# none and their p-values are nan
+@pytest.fixture
+def unreplicated_control():
+    df = csi_bench.generate_datasheet(units=4, treatments=2, isoforms=4, exons=4, replicates=4)
+    return df[~((df["expt_unit"] == "gene1") & (df["treatment"] == csi_bench.control_name)
+                & (df["replicate_ID"] != 1))].reset_index(drop=True)
@@ -0,0 +1,85 @@
+# Tests of the result cache (cache_directory)
+
+# Modules
+from os import listdir
+from os import utime
+from os.path import getsize
+from os.path import join
+from collections import Counter
+import pytest
+import pandas as pd
+import csi
+import csi_bench
+
+control_name = csi_bench.control_name
+
+@pytest.fixture
+def datasheet():
+    return csi_bench.generate_datasheet(units=4, treatments=2, isoforms=4, exons=4, replicates=3)
+
+# df_final of a run with the result cache in cache_directory, and the number
+# of treatments taken from the cache
+def cached_run(df, cache_directory, batch=True, order=2, event_filter=None, exact_max=20):
+    df = csi.preprocess(df)
+    treatment_list, unit_rows = csi.make_trmt_list(df, control_name)
+    counts = Counter()
+    df_final, pending_tests = csi.run_treatments(df, treatment_list, unit_rows, control_name,
+                                                 batch=batch, cache_directory=cache_directory,
+                                                 counts=counts, order=order, 
+                                                 event_filter=event_filter, exact_max=exact_max)
+    csi.score_results(df_final, pending_tests, exact_max=exact_max)
+    return csi.finalize_results(df_final), counts["treatments_cached"]
+
+def n_treatments(df):
+    return len(csi.make_trmt_list(csi.preprocess(df), control_name)[0])
+
+# A rerun takes every treatment from the cache and gives the output of a run
+# without cache
+def test_cache_hits_match_fresh_run(datasheet, tmp_path):
+    first, cached = cached_run(datasheet, str(tmp_path))
+    assert cached == 0
+    second, cached = cached_run(datasheet, str(tmp_path))
+    assert cached == n_treatments(datasheet)
+    pd.testing.assert_frame_equal(second, csi.compute_csi(datasheet, control_name))
+    pd.testing.assert_frame_equal(second, first)
+
+# Editing a treatment recalculates only that treatment; editing a control 
+# recalculates every treatment of its unit
+def test_edited_rows_are_recalculated(datasheet, tmp_path):
+    cached_run(datasheet, str(tmp_path))
+    edited = datasheet.copy()
+    treatment = edited["treatment"] != control_name
+    rows = edited.index[(edited["expt_unit"] == "gene2") & treatment][:2]
+    edited.loc[rows, "relative_abundance"] = edited.loc[rows[::-1], "relative_abundance"].to_numpy()
+    df_final, cached = cached_run(edited, str(tmp_path))
+    assert cached == n_treatments(datasheet) - 1
+    pd.testing.assert_frame_equal(df_final, csi.compute_csi(edited, control_name))
+    
+    units = edited[edited["expt_unit"] == "gene3"][["cell_line", "treatment"]].drop_duplicates()
+    rows = edited.index[(edited["expt_unit"] == "gene3") & ~treatment][:2]
+    edited.loc[rows, "relative_abundance"] = edited.loc[rows[::-1], "relative_abundance"].to_numpy()
+    df_final, cached = cached_run(edited, str(tmp_path))
+    assert cached == n_treatments(datasheet) - (len(units) - 1)
+    pd.testing.assert_frame_equal(df_final, csi.compute_csi(edited, control_name))
+
+# Results of other parameters are not taken from the cache: the largest 
+# exon set, pruning thresholds and, for tests run one event at a time, the 
+# exact Mann-Whitney U limit
+def test_parameters_are_part_of_the_key(datasheet, tmp_path):
+    cached_run(datasheet, str(tmp_path))
+    for parameters in [{"order": 3}, {"event_filter": csi.make_event_filter(0.05)}, 
+                       {"batch": False}]:
+        assert cached_run(datasheet, str(tmp_path), **parameters)[1] == 0
+    assert cached_run(datasheet, str(tmp_path), batch=False, exact_max=None)[1] == 0
+    assert cached_run(datasheet, str(tmp_path), batch=False)[1] == n_treatments(datasheet)
+
+# Eviction removes the least recently used results until the cache fits
+def test_evict_cache_keeps_size_limit(datasheet, tmp_path):
+    cached_run(datasheet, str(tmp_path))
+    names = sorted(name for name in listdir(tmp_path) if name.endswith(".pkl"))
+    for age, name in enumerate(names):
+        utime(join(tmp_path, name), (1000 + age, 1000 + age))
+    sizes = [getsize(join(tmp_path, name)) for name in names]
+    limit = sum(sizes[2:])
+    csi.evict_cache(str(tmp_path), limit / 1024**2)
+    assert sorted(listdir(tmp_path)) == names[2:]
@@ -0,0 +1,32 @@
+# Tests of co-splicing of sets of more than 2 exons (co_splicing_order)
+
+# Modules
+from itertools import combinations
+from collections import Counter
+import csi
+import csi_bench
+
+# Sets of k exons are only examined if all of their subsets of k - 1 exons 
+# had an event (next_exon_sets); this gives the events of examining every 
+# set of k exons. All 6 exons have splicing activity in every unit of the 
+# synthetic datasheet, so every set is combinations(range(6), k).
+def test_pruned_exon_sets_match_full_enumeration(monkeypatch):
+    df = csi_bench.generate_datasheet(units=6, treatments=2, isoforms=8, exons=6, replicates=3)
+    df_prep = csi.preprocess(df)
+    treatment_list, unit_rows = csi.make_trmt_list(df_prep, csi_bench.control_name)
+    counts = Counter()
+    csi.run_treatments(df_prep, treatment_list, unit_rows, csi_bench.control_name, counts=counts,
+                       order=4)
+    pruned = csi.compute_csi(df, csi_bench.control_name, co_splicing_order=4)
+    
+    monkeypatch.setattr(csi, "next_exon_sets", lambda live_sets, k: list(combinations(range(6), k)))
+    full = csi.compute_csi(df, csi_bench.control_name, co_splicing_order=4)
+    assert counts["exon_sets_pruned"] > 0
+    assert pruned["control_exon4"].notna().any()
+    assert pruned.equals(full)
+
+# Candidates are the sets whose every subset is live, in lexicographic order
+def test_next_exon_sets():
+    live = [(0, 1), (0, 2), (0, 3), (1, 2), (2, 3)]
+    assert csi.next_exon_sets(live, 3) == [(0, 1, 2), (0, 2, 3)]
+    assert csi.next_exon_sets([(0, 1, 2), (0, 1, 3), (0, 2, 3)], 4) == []
@@ -0,0 +1,153 @@
+# Equivalence of the ways to run csi.py: streaming, incremental and sharded
+# runs must give the output of a single in-memory run (compute_csi)
+
+# Modules
+import pytest
+import pandas as pd
+import csi
+import csi_bench
+import csi_shard
+from conftest import sample_path
+
+# Datasheets to compare on, as (path, control name): the sample datasheet 
+# and a synthetic one with more experimental units than a bucket or shard
+@pytest.fixture(params=["sample", "synthetic"])
+def datasheet(request, tmp_path):
+    if request.param == "sample":
+        return sample_path, "NC2"
+    path = str(tmp_path / "synthetic.csv")
+    csi_bench.generate_datasheet(units=12, treatments=2, isoforms=4, exons=4, 
+                                 replicates=3).to_csv(path, index=False)
+    return path, csi_bench.control_name
+
+def single_run(path, control_name):
+    return csi.compute_csi(pd.read_csv(path), control_name)
+
+# Rows of df_final in a fixed order, without the "index" column
+def sorted_rows(df_final):
+    df_final = df_final.drop(columns="index")
+    return df_final.sort_values(list(df_final.columns[:6])).reset_index(drop=True)
+
+## Streaming mode
+# Experimental units come out bucket by bucket, so only the order of the 
+# rows can differ
+def test_streaming_matches_single_run(datasheet):
+    path, control_name = datasheet
+    df_final, pending_tests = csi.run_streaming(path, control_name, 20)
+    csi.score_results(df_final, pending_tests)
+    df_final = csi.finalize_results(df_final)
+    pd.testing.assert_frame_equal(sorted_rows(df_final), sorted_rows(single_run(path, control_name)))
+
+## Incremental output
+# Results of the experimental units of a datasheet in memory, for 
+# run_incremental (see iter_unit_results)
+def unit_results(path, control_name):
+    df = csi.preprocess(pd.read_csv(path))
+    treatment_list, unit_rows = csi.make_trmt_list(df, control_name)
+    return lambda start: csi.iter_unit_results(df, treatment_list, unit_rows, control_name, 
+                                               start=start)
+
+def read_bytes(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+# The output datasheet is byte for byte the export of a single run, also 
+# when confidence scores use adjusted p-values (filled in by the last pass)
+@pytest.mark.parametrize("p_value_for_confidence", ["raw", "adjusted"])
+def test_incremental_matches_single_run(datasheet, tmp_path, p_value_for_confidence):
+    path, control_name = datasheet
+    for run in ("incremental", "single"):
+        (tmp_path / run).mkdir()
+    csi.run_incremental(unit_results(path, control_name), str(tmp_path / "incremental"), "csi.csv",
+                        "run", p_value_for_confidence=p_value_for_confidence)
+    df_final = csi.compute_csi(pd.read_csv(path), control_name, 
+                               p_value_for_confidence=p_value_for_confidence)
+    csi.export_datasheet(df_final, "csi.csv", str(tmp_path / "single"))
+    assert read_bytes(tmp_path / "incremental" / "output_datasheets" / "csi.csv") \
+        == read_bytes(tmp_path / "single" / "output_datasheets" / "csi.csv")
+
+# A run interrupted after some experimental units resumes from its 
+# checkpoint and gives the same datasheet as an uninterrupted run
+def test_incremental_resumes_after_interruption(datasheet, tmp_path, caplog):
+    path, control_name = datasheet
+    units = unit_results(path, control_name)
+    for run in ("resumed", "single"):
+        (tmp_path / run).mkdir()
+    
+    def interrupted(start):
+        for done, unit in enumerate(units(start)):
+            if done == 1:
+                raise KeyboardInterrupt
+            yield unit
+    
+    with pytest.raises(KeyboardInterrupt):
+        csi.run_incremental(interrupted, str(tmp_path / "resumed"), "csi.csv", "run")
+    with caplog.at_level("INFO", logger=csi.logger.name):
+        csi.run_incremental(units, str(tmp_path / "resumed"), "csi.csv", "run")
+    assert "Resuming after 1 completed experimental units" in caplog.text
+    csi.run_incremental(units, str(tmp_path / "single"), "csi.csv", "run")
+    assert read_bytes(tmp_path / "resumed" / "output_datasheets" / "csi.csv") \
+        == read_bytes(tmp_path / "single" / "output_datasheets" / "csi.csv")
+
+## Sharded runs
+# csi_shard.py reads its parameters from csi (user_inputs.py), set here to 
+# the defaults of compute_csi; the merge job exports the same datasheet as a
+# single run for any number of shards. Every shard job writes its own 
+# validation report, also into a fresh directory
+@pytest.mark.parametrize("shards", [1, 2, 5])
+def test_shards_match_single_run(datasheet, tmp_path, monkeypatch, shards):
+    path, control_name = datasheet
+    for name, value in {"directory": str(tmp_path / "sharded"), "file_name": path,
+                        "control_name": control_name, "datasheet_name": "csi.csv",
+                        "make_plot": False, "validation_report": "report.json", "stream_chunksize": None,
+                        "cache_directory": None, "compact_dtypes": False, "ci_method": None,
+                        "p_value_for_confidence": "raw", "workers": 1, "batch_tests": True,
+                        "co_splicing_order": 2, "mwu_exact_max": 20, "top_k_events": None,
+                        "min_diff_relative_abundance": None, "min_magnitude": None,
+                        "max_p_value": None}.items():
+        monkeypatch.setattr(csi, name, value)
+    monkeypatch.chdir(tmp_path)
+    for run in ("sharded", "single"):
+        (tmp_path / run).mkdir()
+    
+    for shard in range(shards):
+        csi_shard.run_shard(shard, shards)
+    csi_shard.merge_shards(shards)
+    for shard in range(shards):
+        assert (tmp_path / "sharded" / "output_shards" / f"report.{shard}-of-{shards}.json").exists()
+    csi.export_datasheet(single_run(path, control_name), "csi.csv", str(tmp_path / "single"))
+    assert read_bytes(tmp_path / "sharded" / "output_datasheets" / "csi.csv") \
+        == read_bytes(tmp_path / "single" / "output_datasheets" / "csi.csv")
+
+# A run interrupted in its last pass (before or after the finished datasheet
+# replaced the appended one) only redoes that pass when rerun
+@pytest.mark.parametrize("interruption", ["before", "after"])
+def test_incremental_resumes_last_pass(tmp_path, monkeypatch, interruption):
+    units = unit_results(sample_path, "NC2")
+    for run in ("resumed", "single"):
+        (tmp_path / run).mkdir()
+    csi.run_incremental(units, str(tmp_path / "single"), "csi.csv", "run", 
+                        p_value_for_confidence="adjusted")
+    
+    def interrupt(*args):
+        raise KeyboardInterrupt
+    save_manifest = csi.save_manifest
+    
+    def interrupt_when_complete(manifest_path, manifest):
+        if manifest["complete"]:
+            raise KeyboardInterrupt
+        save_manifest(manifest_path, manifest)
+    
+    with monkeypatch.context() as patch:
+        if interruption == "before":
+            patch.setattr(csi, "finish_incremental", interrupt)
+        else:
+            patch.setattr(csi, "save_manifest", interrupt_when_complete)
+        with pytest.raises(KeyboardInterrupt):
+            csi.run_incremental(units, str(tmp_path / "resumed"), "csi.csv", "run",
+                                p_value_for_confidence="adjusted")
+    csi.run_incremental(lambda start: pytest.fail("units recalculated"), 
+                        str(tmp_path / "resumed"), "csi.csv", "run", 
+                        p_value_for_confidence="adjusted")
+    assert read_bytes(tmp_path / "resumed" / "output_datasheets" / "csi.csv") \
+        == read_bytes(tmp_path / "single" / "output_datasheets" / "csi.csv")
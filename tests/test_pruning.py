@@ -0,0 +1,31 @@
+# Tests of early pruning of events (EventFilter)
+
+# Modules
+import pytest
+import pandas as pd
+import csi
+import csi_bench
+
+# Pruned runs give the default output filtered afterwards: events with 
+# negative diff_relative_abundance or a raw p-value above max_p_value 
+# dropped, then the top_k events by confidence score of every experimental 
+# unit kept (of equal scores the first events), in their order. Adjusted 
+# p-values are calculated over the events kept only, so they are not compared.
+@pytest.mark.parametrize("batch_tests", [True, False])
+@pytest.mark.parametrize("max_p_value, top_k_events", [(0.5, 3), (1, 5), (None, 8), (0.3, None)])
+def test_pruning_matches_filtering_afterwards(batch_tests, max_p_value, top_k_events):
+    df = csi_bench.generate_datasheet(units=6, treatments=3, isoforms=5, exons=5, replicates=3)
+    default = csi.compute_csi(df, csi_bench.control_name, batch_tests=batch_tests)
+    pruned = csi.compute_csi(df, csi_bench.control_name, batch_tests=batch_tests, 
+                             min_diff_relative_abundance=0, max_p_value=max_p_value, 
+                             top_k_events=top_k_events)
+    
+    expected = default
+    if max_p_value is not None:
+        expected = expected[expected["p-value"] <= max_p_value]
+    if top_k_events is not None:
+        expected = (expected.sort_values("confidence_score", ascending=False, kind="stable")
+                    .groupby(["expt_unit", "cell_line"], sort=False).head(top_k_events).sort_index())
+    columns = [x for x in default.columns if x not in ("index", "adjusted_p-value")]
+    assert len(pruned) < len(default)
+    pd.testing.assert_frame_equal(pruned[columns], expected[columns].reset_index(drop=True))
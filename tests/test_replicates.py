@@ -0,0 +1,27 @@
+# Tests of the merging of biological replicates
+
+# Modules
+import numpy as np
+import pandas as pd
+import csi
+
+# Replicates of an isoform become one row with the relative abundances in 
+# replicate_ID order and their mean
+def test_merge_replicates_orders_by_replicate_id(sample):
+    merged = csi.merge_replicates(sample.sort_values("replicate_ID", ascending=False))
+    replicated = merged[merged["replicates"].notna()]
+    assert len(merged) == 18 and len(replicated) > 0
+    for _, row in replicated.iterrows():
+        rows = sample[(sample[["expt_unit", "cell_line", "treatment", "isoform", "exons"]]
+                       == row[["expt_unit", "cell_line", "treatment", "isoform", "exons"]]).all(axis=1)]
+        assert row["replicates"] == rows.sort_values("replicate_ID")["relative_abundance"].tolist()
+        assert np.isclose(row["relative_abundance"], np.mean(row["replicates"]))
+
+# A datasheet without any replicate has no groups to slice: every row is 
+# kept as it is and no event is tested
+def test_datasheet_without_replicates(sample):
+    single = sample.drop_duplicates(list(sample.columns[:-2])).reset_index(drop=True)
+    merged = csi.merge_replicates(single)
+    assert len(merged) == len(single) and merged["replicates"].isna().all()
+    df_final = csi.compute_csi(single, "NC2")
+    assert len(df_final) > 0 and (df_final["p-value"] == 1).all()
@@ -0,0 +1,36 @@
+# Tests of resampling intervals of diff_relative_abundance (ci_method)
+
+# Modules
+import numpy as np
+import pandas as pd
+import pytest
+import csi
+import csi_bench
+
+# df_final with p-values and the replicate lists that resample_ci needs
+@pytest.fixture
+def scored():
+    df = csi.preprocess(csi_bench.generate_datasheet(units=6, treatments=2, isoforms=4, exons=4,
+                                                     replicates=4))
+    treatment_list, unit_rows = csi.make_trmt_list(df, csi_bench.control_name)
+    df_final, pending_tests = csi.run_treatments(df, treatment_list, unit_rows, 
+                                                 csi_bench.control_name, keep_replicates=True)
+    csi.score_results(df_final, pending_tests)
+    return df_final
+
+# The interval of a row depends only on its replicates and the seed: not on 
+# the chunks of rows resampled together, nor on the other rows or their order
+@pytest.mark.parametrize("method", ["bootstrap", "permutation"])
+def test_resampling_does_not_depend_on_chunks_or_row_order(scored, method):
+    default = scored.copy()
+    csi.resample_ci(default, method, 200)
+    assert default["ci_low"].notna().any()
+    
+    chunked = scored.copy()
+    csi.resample_ci(chunked, method, 200, chunk_mb=0.001)
+    pd.testing.assert_frame_equal(chunked, default)
+    
+    rows = np.random.default_rng(0).permutation(len(scored))
+    shuffled = scored.iloc[rows[: len(rows) // 2]].copy()
+    csi.resample_ci(shuffled, method, 200)
+    pd.testing.assert_frame_equal(shuffled, default.iloc[rows[: len(rows) // 2]])
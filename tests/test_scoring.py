@@ -0,0 +1,40 @@
+# Tests of pairwise tests, p-value adjustment and scoring
+
+# Modules
+import numpy as np
+import csi
+
+## Benjamini-Hochberg
+def test_benjamini_hochberg_matches_reference():
+    p = np.array([0.01, 0.04, 0.03, 0.2, 0.5])
+    expected = np.array([0.05, 0.2 / 3, 0.2 / 3, 0.25, 0.5])
+    assert np.allclose(csi.benjamini_hochberg(p), expected)
+
+# Missing p-values stay missing and are not counted as tests
+def test_benjamini_hochberg_keeps_nan_rows_apart():
+    adjusted = csi.benjamini_hochberg([0.01, np.nan, 0.02, 0.5])
+    assert np.isnan(adjusted[1])
+    assert np.allclose(adjusted[[0, 2, 3]], csi.benjamini_hochberg([0.01, 0.02, 0.5]))
+    assert np.isnan(csi.benjamini_hochberg([np.nan])).all()
+    assert len(csi.benjamini_hochberg([])) == 0
+
+# Events of a unit whose control has no replicates are not tested (p-value 
+# 1, like too few replicates), so every event has a confidence score and can
+# be plotted
+def test_unreplicated_control_is_untested(unreplicated_control, tmp_path):
+    df_final = csi.compute_csi(unreplicated_control, "NC", p_value_for_confidence="adjusted")
+    unit = df_final["expt_unit"] == "gene1"
+    assert unit.any() and (~unit).any()
+    assert (df_final.loc[unit, "p-value"] == 1).all()
+    assert df_final[["p-value", "adjusted_p-value", "confidence_score"]].notna().all().all()
+    csi.plot(df_final, "csi", str(tmp_path))
+    assert (tmp_path / "output_plots" / "csi.html").exists()
+
+## Mann-Whitney U tests
+# Tests one event at a time (batch_tests False) give the same p-values as 
+# batched tests, also for events whose control has no replicates
+def test_unbatched_tests_match_batched(unreplicated_control):
+    batched = csi.compute_csi(unreplicated_control, "NC")
+    unbatched = csi.compute_csi(unreplicated_control, "NC", batch_tests=False)
+    assert unbatched["p-value"].notna().all()
+    assert unbatched.equals(batched)
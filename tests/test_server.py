@@ -0,0 +1,85 @@
+# Tests of the job server (csi_server.py)
+
+# Modules
+import json
+import asyncio
+from os import walk
+from os.path import join
+import pandas as pd
+import csi
+import csi_server
+from conftest import sample_path
+
+# Run coroutine check(server) against a job server with one worker whose 
+# jobs are kept in directory
+def with_server(directory, check):
+    async def run():
+        server = csi_server.JobServer(str(directory), workers=1)
+        try:
+            return await check(server)
+        finally:
+            server.pool.shutdown()
+    return asyncio.run(run())
+
+# Submit a datasheet and wait until its job is finished; returns the job
+async def finished_job(server, query, body):
+    status, content_type, response = server.respond("POST", "/jobs?" + query, body)
+    assert status == 202
+    job_id = json.loads(response)["id"]
+    while server.jobs[job_id]["status"] not in ("done", "failed"):
+        await asyncio.sleep(0.05)
+    return server.jobs[job_id]
+
+# A job gives the datasheet of compute_csi and a plot, both inside its job
+# directory; requests cannot name files
+def test_job_results_stay_in_job_directory(tmp_path):
+    jobs = tmp_path / "jobs"
+    with open(sample_path, "rb") as file:
+        body = file.read()
+    
+    async def check(server):
+        status, content_type, response = server.respond(
+            "POST", "/jobs?control_name=NC2&plot_name=../../escaped", body)
+        assert status == 400
+        job = await finished_job(server, "control_name=NC2", body)
+        assert job["status"] == "done"
+        return server.respond("GET", f"/jobs/{job['id']}/datasheet", b""), \
+            server.respond("GET", f"/jobs/{job['id']}/plot", b"")
+    datasheet, plot = with_server(jobs, check)
+    
+    assert datasheet[0] == 200 and plot[0] == 200
+    expected = csi.compute_csi(pd.read_csv(sample_path), "NC2").to_csv(index=False).encode()
+    assert datasheet[2] == expected
+    files = [join(root, name) for root, dirs, names in walk(tmp_path) for name in names]
+    assert all(path.startswith(str(jobs)) for path in files)
+
+# Validation errors fail the job with their message instead of stopping the
+# worker
+def test_invalid_job_fails(tmp_path):
+    with open(sample_path, "rb") as file:
+        body = file.read()
+    
+    async def check(server):
+        failed = await finished_job(server, "control_name=missing", body)
+        done = await finished_job(server, "control_name=NC2", body)
+        return failed, done
+    failed, done = with_server(tmp_path, check)
+    assert failed["status"] == "failed" and "Validation" in failed["error"]
+    assert done["status"] == "done"
+
+# Requests from web pages (with an Origin header) are refused
+def test_requests_from_web_pages_are_refused(tmp_path):
+    async def request(server, headers):
+        listener = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        async with listener:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"GET /status HTTP/1.1\r\n{headers}\r\n".encode())
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+        return response.split(b" ")[1]
+    
+    async def check(server):
+        return await request(server, "Origin: http://example.com\r\n"), await request(server, "")
+    assert with_server(tmp_path, check) == (b"403", b"200")
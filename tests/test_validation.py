@@ -0,0 +1,63 @@
+# Tests of datasheet validation and parameter errors
+
+# Modules
+import json
+import pytest
+import pandas as pd
+import csi
+import csi_bench
+
+# Problems of the datasheet raise DatasheetError with the issues found, so 
+# that callers of compute_csi can handle them instead of exiting
+def test_missing_control_raises(sample):
+    with pytest.raises(csi.DatasheetError) as error:
+        csi.compute_csi(sample, "missing")
+    assert "Datasheet Validation Error" in str(error.value)
+    assert [issue["rule"] for issue in error.value.issues if issue["severity"] == "error"] == ["missing_control"]
+
+def test_invalid_parameters_raise(sample):
+    with pytest.raises(csi.ParameterError):
+        csi.compute_csi(sample, "NC2", p_value_for_confidence="both")
+    with pytest.raises(csi.ParameterError):
+        csi.compute_csi(sample, "NC2", top_k_events=0)
+    with pytest.raises(csi.ParameterError):
+        csi.compute_csi(sample, "NC2", ci_method="jackknife")
+
+# co_splicing_order below 2 would examine no exon sets and return nothing
+@pytest.mark.parametrize("order", [1, 0, "3", 2.0, True])
+def test_invalid_co_splicing_order_raises(sample, order):
+    with pytest.raises(csi.ParameterError):
+        csi.compute_csi(sample, "NC2", co_splicing_order=order)
+
+# Resampling parameters are checked before any calculation
+@pytest.mark.parametrize("parameters", [{"ci_resamples": 0}, {"ci_resamples": 10.5}, 
+                                        {"ci_level": 1.5}, {"ci_level": 0}, {"ci_chunk_mb": 0}])
+def test_invalid_resampling_raises(sample, parameters):
+    with pytest.raises(csi.ParameterError):
+        csi.compute_csi(sample, "NC2", ci_method="bootstrap", **parameters)
+
+# Both are ValueErrors, not SystemExit
+def test_errors_are_value_errors(sample):
+    with pytest.raises(ValueError):
+        csi.compute_csi(sample, "missing")
+
+# Streaming mode validates the datasheet bucket by bucket but reports the 
+# same problems as validating it whole: rows numbered as in the datasheet, 
+# one problem per rule with the examples of all buckets
+def test_streaming_reports_like_whole_datasheet(tmp_path):
+    df = csi_bench.generate_datasheet(units=12, treatments=2, isoforms=4, exons=4, replicates=3)
+    df = df[~((df["expt_unit"] == "gene7") & (df["treatment"] == csi_bench.control_name))]
+    df = df.reset_index(drop=True)
+    df.loc[[5, 300], "relative_abundance"] = 2.0
+    path = str(tmp_path / "invalid.csv")
+    df.to_csv(path, index=False)
+    
+    issues = csi.validate_datasheet(pd.read_csv(path), csi_bench.control_name)
+    with pytest.raises(csi.DatasheetError) as error:
+        csi.run_streaming(path, csi_bench.control_name, 20, report_path=str(tmp_path / "report.json"))
+    assert [issue["rule"] for issue in issues] == ["relative_abundance", "relative_abundance_sum", 
+                                                   "missing_control"]
+    assert issues[0]["rows"] == [5, 300]
+    assert error.value.issues == issues
+    with open(tmp_path / "report.json") as file:
+        assert json.load(file)["issues"] == issues
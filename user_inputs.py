@@ -1,9 +1,10 @@
 ## User-defined parameters
 
-# Directory where input datasheet (CSV format) is found
+# Directory where input datasheet is found
 directory = "E:/OneDrive/DW Computational Biology/Co-splicing_project/co-splicing_index"
 
-# File name of datasheet (CSV format)
+# File name of datasheet; the format is chosen from the extension:
+# .csv, .parquet or .feather (Parquet and Feather need pyarrow)
 file_name = "test_input.csv"
 
 # Name of control under "treatment" column in your datasheet 
@@ -12,5 +13,125 @@ control_name = "NC2"
 # Name of desired output plot file name
 plot_name = "test_output"
 
-# Name of desired output datasheet file name
+# Generate the HTML plot; False only computes and exports the datasheet 
+# (plotly is then not loaded)
+make_plot = True
+
+# Name of desired output datasheet file name; add .parquet or .feather to 
+# write a columnar datasheet instead of CSV
 datasheet_name = "test_output"
+
+# Write the rows of each experimental unit to the CSV output datasheet as
+# soon as it is calculated, with a checkpoint manifest next to it, so that an
+# interrupted run resumes after the last completed experimental unit.
+# Adjusted p-values are filled in a last pass over the file and the plot is
+# drawn from the finished file
+incremental_output = False
+
+# Run pairwise tests of all exon pairs together in batched calls (True), 
+# or one exon pair at a time (False); p-values are the same
+batch_tests = True
+
+# p-value used in confidence score: "raw" or "adjusted" (Benjamini-Hochberg)
+p_value_for_confidence = "raw"
+
+# Number of processes to run treatments in (1 runs everything in this process)
+workers = 1
+
+# Largest number of exons whose co-splicing is examined together: 2 examines
+# exon pairs, 3 also exon triplets, and so on. Sets of more exons add 
+# control_exon3 ... columns to the output datasheet
+co_splicing_order = 2
+
+# Hold the datasheet in a compact representation in memory: identifiers as 
+# categoricals, exon flags as Int8, abundances as float32 and replicates 
+# packed into float32 columns. Uses several times less memory on large 
+# screens; abundances keep about 7 significant digits, so results can differ
+# in the last digits. Rows with negative diff_relative_abundance are left out
+# of the output, so an event whose difference is within rounding of 0 can be
+# kept or left out unlike a run without compact_dtypes: the output can have a
+# few rows more or fewer. The working-set size before and after is logged
+compact_dtypes = False
+
+# Resampling intervals of diff_relative_abundance on every row with at least
+# 2 replicates in treatment and control: "bootstrap" adds ci_low and ci_high
+# (percentile interval), "permutation" also adds permutation_p-value; None
+# does not resample. Resampled differences of ci_resamples draws are computed
+# in chunks of rows of at most ci_chunk_mb megabytes; results depend only on
+# ci_seed and the replicates of the row
+ci_method = None
+ci_resamples = 1000
+ci_level = 0.95
+ci_seed = 0
+ci_chunk_mb = 64
+
+# Early pruning of events, so that large screens only test and score the 
+# events of interest (None disables a threshold): events with 
+# diff_relative_abundance below min_diff_relative_abundance or magnitude 
+# below min_magnitude are dropped before their pairwise tests (0 drops the 
+# negative events, which are filtered out of the output anyway), events with
+# a raw p-value above max_p_value after their test. top_k_events keeps only 
+# the k events of every experimental unit (expt_unit and cell_line) with the
+# highest confidence scores and needs p_value_for_confidence = "raw" (with
+# min_diff_relative_abundance = 0, negative events do not count towards k). 
+# Adjusted p-values are then calculated over the events kept only
+min_diff_relative_abundance = None
+min_magnitude = None
+max_p_value = None
+top_k_events = None
+
+# Mann-Whitney U tests of events without ties and with at most mwu_exact_max
+# replicates in treatment and control use the exact null distribution of U,
+# built once per pair of replicate numbers and cached, so each test is a 
+# rank sum and a table lookup. Tests with ties or more replicates use the 
+# normal approximation with tie and continuity correction. None keeps the 
+# results of earlier versions (exact only if treatment or control has at 
+# most 8 replicates and there are no ties); p-values differ only for events 
+# without ties with more than 8 replicates in both
+mwu_exact_max = 20
+
+# Streaming mode for very large datasheets: read the datasheet in chunks of 
+# this many rows and process a few experimental units at a time, so memory 
+# use is bounded (None loads the whole datasheet at once). The output has the
+# rows of a normal run, with experimental units in a different order
+stream_chunksize = None
+
+# Directory for temporary spill files in streaming mode (None uses the system
+# temporary directory)
+spill_directory = None
+
+# Directory of the result cache: results of each treatment are cached under
+# a hash of its rows and its control rows, so a re-run only calculates the
+# treatments that changed (None disables the cache)
+cache_directory = None
+
+# Size cap of the result cache in megabytes; least recently used results are
+# removed above it
+cache_size_limit = 1024
+
+# Plots with more events than this draw their markers with WebGL so that 
+# large screens stay interactive
+plot_webgl_threshold = 5000
+
+# Plots with more events than this show a binned density (number of events
+# per cell of plot_bins x plot_bins) instead of every event (None: never)
+plot_density_threshold = None
+plot_bins = 200
+
+# plotly.js in the HTML plot: True inlines it in every report, "directory" 
+# writes one plotly.min.js to output_plots that all reports share, "cdn" 
+# loads it from the internet
+plot_include_plotlyjs = True
+
+# Logging level of progress messages: "INFO" (default), "DEBUG" (also logs
+# every exon pair pattern examined and stage timings), "WARNING" (quiet)
+log_level = "INFO"
+
+# JSON file for the wall time of each stage and counters (pairs examined, 
+# patterns skipped, tests run by type, rows emitted); None does not write it
+metrics_file = None
+
+# The datasheet is checked against all rules before any calculation; 
+# problems are logged and, if this is a file name, also written to it as 
+# JSON. Errors stop the run, warnings do not (None: no JSON report)
+validation_report = None